@@ -0,0 +1,139 @@
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+import pygame as pg
+from settings import *
+
+
+class LazySound:
+    # A sound that is only loaded the first time it is played.
+    def __init__(self, assets, filename, volume):
+        self.assets = assets
+        self.filename = filename
+        self.volume = volume
+        self.sound = None
+
+    def play(self, *args, **kwargs):
+        if self.sound is None:
+            self.sound = self.assets.decode_sound(self.filename, self.volume)
+        return self.sound.play(*args, **kwargs)
+
+    def set_volume(self, volume):
+        self.volume = volume
+        if self.sound is not None:
+            self.sound.set_volume(volume)
+
+
+class AssetManager:
+    # Loads the images and sounds. Files are decoded on a thread pool, and
+    # the images are converted for the display on the main thread as they
+    # finish (converting needs the display). Images are reference counted by
+    # the levels that use them, so switching levels can free the images the
+    # next level does not use. Freed images are loaded again if they are
+    # asked for. Assets in the asset pack (if there is one) are loaded from
+    # it instead of from their files.
+    def __init__(self, pack=None, workers=ASSET_WORKERS):
+        self.pack = pack
+        self.pool = ThreadPoolExecutor(workers)
+        # Name to (kind, future) for the assets that are being decoded.
+        self.pending = {}
+        self.images = {}
+        self.sounds = {}
+        # Name to file name, for loading freed images again.
+        self.files = {}
+        self.refs = {}
+        # Progress of the assets that were started.
+        self.total = 0
+        self.done = 0
+
+    def load_image(self, name, filename):
+        self.files[name] = filename
+        if name not in self.images and name not in self.pending:
+            self.pending[name] = ("image", self.pool.submit(
+                self.decode_image, filename))
+            self.total += 1
+
+    def load_sound(self, name, filename, volume=1):
+        if name not in self.sounds and name not in self.pending:
+            self.pending[name] = ("sound", self.pool.submit(
+                self.decode_sound, filename, volume))
+            self.total += 1
+
+    def decode_image(self, filename):
+        if self.pack is not None and filename in self.pack:
+            return self.pack.image(filename)
+        return pg.image.load(filename)
+
+    def decode_sound(self, filename, volume=1):
+        if self.pack is not None and filename in self.pack:
+            sound = self.pack.sound(filename)
+        else:
+            sound = pg.mixer.Sound(filename)
+        sound.set_volume(volume)
+        return sound
+
+    def open(self, filename):
+        # A file object for a font or music file, or the file name if it is
+        # not in the pack (both can be loaded by pygame).
+        if self.pack is not None and filename in self.pack:
+            return self.pack.open(filename)
+        return filename
+
+    def finish(self, name):
+        # Store a decoded asset.
+        kind, future = self.pending.pop(name)
+        if kind == "image":
+            self.images[name] = future.result().convert_alpha()
+        else:
+            self.sounds[name] = future.result()
+        self.done += 1
+
+    def poll(self):
+        # Store the assets that are decoded. Returns True when everything is
+        # loaded.
+        for name, (kind, future) in list(self.pending.items()):
+            if future.done():
+                self.finish(name)
+        return not self.pending
+
+    def wait(self, progress=None, timeout=1 / FPS):
+        # Load everything, calling progress(done, total) about every timeout
+        # seconds while waiting.
+        while not self.poll():
+            if progress:
+                progress(self.done, self.total)
+            wait([future for kind, future in self.pending.values()],
+                 timeout, FIRST_COMPLETED)
+        if progress:
+            progress(self.done, self.total)
+
+    def image(self, name):
+        # An image, loaded now if it has not finished loading yet or was
+        # freed.
+        if name in self.pending:
+            self.finish(name)
+        elif name not in self.images:
+            self.images[name] = self.decode_image(
+                self.files[name]).convert_alpha()
+        return self.images[name]
+
+    def sound(self, name):
+        if name in self.pending:
+            self.finish(name)
+        return self.sounds[name]
+
+    def acquire(self, names):
+        # Use images until they are released.
+        for name in names:
+            self.refs[name] = self.refs.get(name, 0) + 1
+            self.image(name)
+
+    def release(self, names):
+        for name in names:
+            self.refs[name] -= 1
+            if not self.refs[name]:
+                del self.refs[name]
+
+    def collect(self):
+        # Free the loaded images that are not used.
+        for name in list(self.images):
+            if name not in self.refs:
+                del self.images[name]
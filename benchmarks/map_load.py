@@ -0,0 +1,54 @@
+# Compare map load time when parsing the TMX file against loading the
+# compiled binary cache.
+#   python benchmarks/map_load.py [map file] [repeats]
+import os
+import sys
+import time
+os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir))
+import pygame as pg
+from mapcache import MapData, compile_map, read_cache
+from tilemap import TiledMap
+
+
+def best_time(function, repeats):
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+    return min(times), sum(times) / len(times)
+
+
+def main():
+    game_folder = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                               os.pardir)
+    filename = sys.argv[1] if len(sys.argv) > 1 else \
+        os.path.join(game_folder, "map", "map1.tmx")
+    repeats = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+
+    pg.init()
+    pg.display.set_mode((1, 1))
+    compile_map(filename)
+
+    results = {
+        "tmx parse": best_time(lambda: MapData.from_tmx(filename), repeats),
+        "binary cache": best_time(lambda: read_cache(filename), repeats),
+        "TiledMap (tmx)": best_time(lambda: TiledMap(filename, False),
+                                    repeats),
+        "TiledMap (cache)": best_time(lambda: TiledMap(filename, True),
+                                      repeats)
+    }
+    print(f"{os.path.basename(filename)}, best of {repeats}:")
+    for name, (best, mean) in results.items():
+        print(f"  {name:<18} best {best * 1000:8.2f} ms"
+              f"   mean {mean * 1000:8.2f} ms")
+    speedup = results["tmx parse"][0] / results["binary cache"][0]
+    print(f"  cache speedup      {speedup:.1f}x")
+
+    pg.quit()
+
+
+if __name__ == "__main__":
+    main()
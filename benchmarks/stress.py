@@ -0,0 +1,270 @@
+# Headless benchmark of the update and draw loops on generated levels.
+#   python benchmarks/stress.py                     run every scenario
+#   python benchmarks/stress.py --kinds coins --sizes 10 1000 100000
+#   python benchmarks/stress.py --save-baseline     store the results
+#   python benchmarks/stress.py --backend arrays    use the array entity store
+# Every scenario runs in its own process so its peak memory can be measured.
+# Results are compared against benchmarks/baseline.json, and the exit code is
+# 1 if any scenario got slower or bigger than the allowed threshold.
+# Timings depend on the machine, so the baseline is not committed, each
+# machine keeps its own. To check a change for regressions:
+#   git stash                                        (or check out main)
+#   python benchmarks/stress.py --save-baseline      (before the change)
+#   git stash pop
+#   python benchmarks/stress.py                      (after the change)
+# Saving adds the scenarios that were run to the baseline, so the backends
+# and sizes can be saved in separate runs. Without a baseline, or for
+# scenarios that are not in it, there is a warning and nothing is checked.
+import os
+import sys
+import json
+import math
+import time
+import random
+import argparse
+import subprocess
+os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+os.environ.setdefault("SDL_AUDIODRIVER", "dummy")
+BENCHMARK_FOLDER = os.path.dirname(os.path.abspath(__file__))
+GAME_FOLDER = os.path.dirname(BENCHMARK_FOLDER)
+sys.path.insert(0, GAME_FOLDER)
+
+KINDS = ["walls", "coins", "platforms", "mixed"]
+SIZES = [10, 100, 1000, 10000, 100000]
+BASELINE_FILE = os.path.join(BENCHMARK_FOLDER, "baseline.json")
+# Results that can get worse (higher) before it is a regression, relative to
+# the baseline.
+TIME_RESULTS = ["load_ms", "update_ms", "update_p99", "draw_ms", "draw_p99"]
+MEMORY_RESULTS = ["peak_mb"]
+
+
+def scenario_counts(kind, size):
+    # Number of walls, coins and moving platforms in a scenario.
+    if kind == "walls":
+        return size, 0, 0
+    if kind == "coins":
+        return 0, size, 0
+    if kind == "platforms":
+        return 0, 0, size
+    return size, size, max(1, size // 10)
+
+
+def make_level(walls, coins, platforms, seed=0):
+    # Generate map data in the same format as a loaded TMX map, with one
+    # tile sized wall, coin or platform per random free tile. The level grows
+    # with the number of objects so the density stays about the same.
+    from settings import TILESIZE
+    from mapcache import MapData, MapObject, TileLayer, load_map_data
+    from array import array
+
+    rng = random.Random(seed)
+    # Platforms take two tiles and move around, so give them more room.
+    cells = max(40 * 30, 4 * (walls + coins) + 16 * platforms)
+    width = math.ceil(math.sqrt(cells * 4 / 3))
+    height = math.ceil(cells / width) + 1
+    free = list(range(width * (height - 1)))
+    rng.shuffle(free)
+
+    # Use the tiles from the real map.
+    tileset = load_map_data(os.path.join(GAME_FOLDER, "map", "map1.tmx"))
+    wall_gid = next(gid for gid, image in enumerate(tileset.images) if image)
+    data = array("I", bytes(4 * width * height))
+
+    objects = []
+    next_id = 1
+
+    def add(x, y, object_width, object_height, name, object_type, kind):
+        nonlocal next_id
+        objects.append(MapObject(next_id, name, object_type, x, y,
+                                 object_width, object_height,
+                                 {"object": kind}))
+        next_id += 1
+
+    # A floor along the bottom so the player has something to stand on.
+    add(0, (height - 1) * TILESIZE, width * TILESIZE, TILESIZE, "wall",
+        "wall", "obstacle")
+    for x in range(width):
+        data[(height - 1) * width + x] = wall_gid
+    for _ in range(walls):
+        cell = free.pop()
+        x, y = cell % width, cell // width
+        data[cell] = wall_gid
+        add(x * TILESIZE, y * TILESIZE, TILESIZE, TILESIZE, "wall", "wall",
+            "obstacle")
+    for _ in range(coins):
+        cell = free.pop()
+        x, y = cell % width, cell // width
+        add(x * TILESIZE, y * TILESIZE, TILESIZE, TILESIZE, "item", "coin",
+            "item")
+    for _ in range(platforms):
+        cell = free.pop()
+        x, y = cell % width, cell // width
+        add(x * TILESIZE, y * TILESIZE, TILESIZE * 2, 20, "wall",
+            "moving_wall", "moving_obstacle")
+
+    layers = [TileLayer("Ground", True, width, height, data)]
+    return MapData(width, height, TILESIZE, TILESIZE, layers,
+                   tileset.images, objects, {})
+
+
+def run_scenario(kind, size, update_frames, draw_frames, backend):
+    import pygame as pg
+    from main import Game
+    from inputs import ScriptedInput
+    from tilemap import TiledMap
+    from settings import TILESIZE
+
+    script = [{"held": ["d"], "frames": 40},
+              {"held": ["d", "space"], "pressed": ["space"], "frames": 20},
+              {"held": ["a"], "frames": 40},
+              {"held": ["a", "space"], "pressed": ["space"], "frames": 20}]
+    game = Game(headless=True, input_source=ScriptedInput(script, loop=True),
+                entity_backend=backend)
+
+    map_data = make_level(*scenario_counts(kind, size))
+    start = time.perf_counter()
+    game.create_level(TiledMap(None, map_data=map_data))
+    game.create_player(map_data.width * TILESIZE / 2,
+                       (map_data.height - 2) * TILESIZE)
+    load_time = time.perf_counter() - start
+
+    def frame_times(frames, draw):
+        times = []
+        for _ in range(frames):
+            start = time.perf_counter()
+            game.input.next_frame()
+            game.events()
+            game.update()
+            if draw:
+                game.draw()
+            times.append((time.perf_counter() - start) * 1000)
+        return times
+
+    update_times = frame_times(update_frames, False)
+    draw_times = frame_times(draw_frames, True)
+
+    import resource
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform != "darwin":
+        # Linux reports kilobytes, macOS bytes.
+        peak *= 1024
+    pg.quit()
+    return {
+        "load_ms": load_time * 1000,
+        "update_ms": sum(update_times) / len(update_times),
+        "update_p99": percentile(update_times, 99),
+        "draw_ms": sum(draw_times) / len(draw_times),
+        "draw_p99": percentile(draw_times, 99),
+        "peak_mb": peak / 1024 / 1024
+    }
+
+
+def percentile(values, percent):
+    values = sorted(values)
+    return values[round((len(values) - 1) * percent / 100)]
+
+
+def compare(name, result, baseline, time_threshold, memory_threshold):
+    # Regressions in one scenario, as text.
+    regressions = []
+    for key in TIME_RESULTS + MEMORY_RESULTS:
+        if key not in baseline:
+            continue
+        threshold = memory_threshold if key in MEMORY_RESULTS \
+            else time_threshold
+        if result[key] > baseline[key] * (1 + threshold):
+            regressions.append(f"{name} {key}: {result[key]:.2f} > "
+                               f"{baseline[key]:.2f} "
+                               f"(+{threshold * 100:.0f}% allowed)")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark the game loops on generated levels.")
+    parser.add_argument("--kinds", nargs="+", default=KINDS, choices=KINDS)
+    parser.add_argument("--sizes", nargs="+", type=int, default=SIZES)
+    parser.add_argument("--update-frames", type=int, default=60)
+    parser.add_argument("--draw-frames", type=int, default=30)
+    parser.add_argument("--backend", default="sprites",
+                        choices=["sprites", "arrays"],
+                        help="how items and static walls are stored")
+    parser.add_argument("--baseline", default=BASELINE_FILE)
+    parser.add_argument("--save-baseline", action="store_true")
+    parser.add_argument("--threshold", type=float, default=0.25,
+                        help="allowed relative slow down")
+    parser.add_argument("--memory-threshold", type=float, default=0.10,
+                        help="allowed relative memory increase")
+    parser.add_argument("--json", default=None, help="save results to a file")
+    # Used for running one scenario in a child process.
+    parser.add_argument("--run", nargs=2, default=None,
+                        help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run:
+        kind, size = args.run[0], int(args.run[1])
+        result = run_scenario(kind, size, args.update_frames,
+                              args.draw_frames, args.backend)
+        print(json.dumps(result))
+        return 0
+
+    baseline = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as file:
+            baseline = json.load(file)
+    elif not args.save_baseline:
+        print(f"Warning: there is no baseline at {args.baseline}, so the "
+              f"results are not checked for regressions. Save one with "
+              f"--save-baseline before making changes.", file=sys.stderr)
+
+    results = {}
+    regressions = []
+    # Scenarios that are not in the baseline.
+    missing = []
+    print(f"{'scenario':<22}{'load ms':>10}{'update ms':>11}{'p99':>9}"
+          f"{'draw ms':>10}{'p99':>9}{'peak MB':>10}")
+    for kind in args.kinds:
+        for size in args.sizes:
+            name = f"{kind}-{size}"
+            if args.backend != "sprites":
+                name += f"-{args.backend}"
+            output = subprocess.run(
+                [sys.executable, os.path.abspath(__file__), "--run", kind,
+                 str(size), "--update-frames", str(args.update_frames),
+                 "--draw-frames", str(args.draw_frames),
+                 "--backend", args.backend],
+                capture_output=True, text=True, check=True).stdout
+            result = json.loads(output.strip().splitlines()[-1])
+            results[name] = result
+            print(f"{name:<22}{result['load_ms']:>10.1f}"
+                  f"{result['update_ms']:>11.3f}{result['update_p99']:>9.3f}"
+                  f"{result['draw_ms']:>10.3f}{result['draw_p99']:>9.3f}"
+                  f"{result['peak_mb']:>10.1f}")
+            if args.save_baseline:
+                continue
+            if name in baseline:
+                regressions += compare(name, result, baseline[name],
+                                       args.threshold, args.memory_threshold)
+            else:
+                missing.append(name)
+
+    if args.json:
+        with open(args.json, "w") as file:
+            json.dump(results, file, indent=1)
+    if args.save_baseline:
+        baseline.update(results)
+        with open(args.baseline, "w") as file:
+            json.dump(baseline, file, indent=1)
+        print(f"Saved baseline to {args.baseline}")
+    elif baseline and missing:
+        print(f"Warning: not in the baseline, so not checked: "
+              f"{', '.join(missing)}", file=sys.stderr)
+    if regressions:
+        print("Regressions:")
+        print("\n".join(regressions))
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,49 @@
+# Measure how many agent steps a second the vectorized environment runs,
+# with random actions.
+#   python benchmarks/vec_env.py [map file] [agents] [steps]
+import os
+import sys
+import time
+os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir))
+import numpy as np
+import pygame as pg
+from vecenv import VecEnv, ACTION_LEFT, ACTION_RIGHT, ACTION_JUMP
+
+
+def main():
+    game_folder = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                               os.pardir)
+    filename = sys.argv[1] if len(sys.argv) > 1 else \
+        os.path.join(game_folder, "map", "map1.tmx")
+    agents = int(sys.argv[2]) if len(sys.argv) > 2 else 4096
+    steps = int(sys.argv[3]) if len(sys.argv) > 3 else 500
+
+    pg.init()
+    env = VecEnv.from_map(filename, agents)
+    env.reset()
+    # Mostly running right, sometimes jumping.
+    rng = np.random.default_rng(0)
+    choices = np.array([0, ACTION_LEFT, ACTION_RIGHT, ACTION_RIGHT,
+                        ACTION_RIGHT | ACTION_JUMP, ACTION_JUMP])
+    actions = choices[rng.integers(len(choices), size=(steps, agents))]
+
+    coins = 0
+    resets = 0
+    start = time.perf_counter()
+    for step_actions in actions:
+        observations, rewards, dones = env.step(step_actions)
+        coins += rewards.sum()
+        resets += dones.sum()
+    elapsed = time.perf_counter() - start
+
+    print(f"{os.path.basename(filename)}, {agents} agents, {steps} steps:")
+    print(f"  {elapsed:.2f} s, {agents * steps / elapsed:,.0f} agent steps/s")
+    print(f"  {coins:.0f} coins collected, {resets} resets")
+
+    pg.quit()
+
+
+if __name__ == "__main__":
+    main()
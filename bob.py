@@ -0,0 +1,48 @@
+from pytweening import easeInOutSine
+from settings import *
+
+
+class BobTable:
+    # The item bob animation worked out ahead of time. The animation only
+    # depends on the step it starts at, so every item that starts at the
+    # same step shares a table, and the offset of an item after any number of
+    # simulation steps is a lookup instead of being updated every step.
+    def __init__(self, start_step=0):
+        # Run the animation the same way items used to, with the same float
+        # steps, until it gets back to a state it was in before.
+        step = start_step
+        direction = 1
+        states = {}
+        offsets = []
+        while (step, direction) not in states:
+            states[(step, direction)] = len(offsets)
+            # bobbing motion (subtract 0.5 to shift halfway)
+            offset = BOB_RANGE * (easeInOutSine(step / BOB_RANGE) - 0.5)
+            offsets.append(offset * direction)
+            # BOB_SPEED is per frame at FPS, so scale it to the simulation
+            # rate.
+            step += BOB_SPEED * FPS / SIM_RATE
+            # switch and reset if hit maximum
+            if step > BOB_RANGE:
+                step = 0
+                direction *= -1
+        # Offsets from the center for each step, which repeat from loop_start
+        # onwards.
+        self.offsets = offsets
+        self.loop_start = states[(step, direction)]
+        self.loop_length = len(offsets) - self.loop_start
+
+    def offset(self, steps):
+        # Offset from the center for the step after this many steps.
+        if steps >= len(self.offsets):
+            steps = self.loop_start + (steps - self.loop_start) % \
+                self.loop_length
+        return self.offsets[steps]
+
+
+def bob_table(start_step=0, cache={}):
+    # Items that start at the same step share the same table.
+    table = cache.get(start_step)
+    if table is None:
+        table = cache[start_step] = BobTable(start_step)
+    return table
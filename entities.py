@@ -1,15 +1,22 @@
 from random import randint
-from pytweening import easeInOutSine
 import pygame as pg
 from pygame.locals import *
 from pygame.math import Vector2 as Vec
 from settings import *
+from paths import compile_movement
+from bob import bob_table
 
 
 def collide_hit_rect_both(one, two):
     return one.hit_rect.colliderect(two.hit_rect)
 
 
+def sweep_hits(sprites, start, end):
+    # The sprites hit by a rect moving from start to end along one axis.
+    path = start.union(end)
+    return [sprite for sprite in sprites if sprite.hit_rect.colliderect(path)]
+
+
 def screen_wrap(sprite):
     # Edge of screen teleport.
     if sprite.pos.x < 0:
@@ -18,6 +25,15 @@ def screen_wrap(sprite):
         sprite.pos.x = 0
 
 
+def item_image(item_type):
+    # Image file of an item type.
+    if item_type == "coin":
+        item_img = "coinGold.png"
+    else:
+        item_img = "coinGold.png"
+    return item_img
+
+
 class Player(pg.sprite.Sprite):
     def __init__(self, game, x, y, image_string):
         self._layer = PLAYER_LAYER
@@ -35,27 +51,65 @@ class Player(pg.sprite.Sprite):
         self.on_ground = False
         self.jumping = False
         self.gravity_orientation = 1
+        # Movement mode, and the rotation for spin movement (degrees
+        # counterclockwise).
+        self.movement_type = PLAYER_MOVEMENT_TYPE
+        self.rot = 0
+        self.rot_vel = 0
+        self.rot_acc = 0
         # Sprite image.
         self.image_string = image_string
-        self.image = game.player_imgs[image_string]
+        self.rotations = game.player_rotations[image_string]
+        self.image = game.assets.image(image_string)
         self.rect = self.image.get_rect()
         self.rect.center = (x, y)
         self.hit_rect = pg.Rect(self.rect.x, self.rect.y,
                                 PLAYER_HIT_RECT_WIDTH, PLAYER_HIT_RECT_HEIGHT)
         self.hit_rect.center = self.rect.center
         self.color = CYAN
+        # Add to the grid used to find sprites on the screen.
+        game.visible_grid.add(self)
+        # Players are always updated.
+        game.scheduler.add(self, "sprites")
 
         self.moving_obstacle = None
 
     def update_image(self):
-        # Use .copy() to not modify the stored image
-        self.image = self.game.player_imgs[self.image_string].copy()
-        self.rect = self.image.get_rect()
+        # The image for the rotation is looked up in the rotation cache, so
+        # no new surface is made.
+        frame = self.rotations.index(self.rot)
+        self.image = self.rotations.images[frame]
 
         # Image details.
-        self.rect = self.image.get_rect()
+        self.rect.size = self.rotations.sizes[frame]
         self.rect.center = (self.pos.x, self.pos.y)
-        self.hit_rect.center = self.rect.center
+        # The hit rect is left where collide_walls put it. Centering it on
+        # the (rounded) position again can move it a pixel into the wall it
+        # is touching, which the next sweep would then hit from the side.
+
+    def snapshot(self):
+        # The player's state, which restore puts back.
+        return (Vec(self.pos), Vec(self.vel), Vec(self.acc),
+                Vec(self.displacement), self.on_ground, self.jumping,
+                self.gravity_orientation, self.movement_type, self.rot,
+                self.rot_vel, self.rot_acc, self.rect.copy(),
+                self.hit_rect.copy(), getattr(self, "previous_center", None),
+                self.moving_obstacle)
+
+    def restore(self, state):
+        (pos, vel, acc, displacement, self.on_ground, self.jumping,
+         self.gravity_orientation, self.movement_type, self.rot, self.rot_vel,
+         self.rot_acc, rect, hit_rect, self.previous_center,
+         self.moving_obstacle) = state
+        self.pos = Vec(pos)
+        self.vel = Vec(vel)
+        self.acc = Vec(acc)
+        self.displacement = Vec(displacement)
+        # The rects are changed in place, they are the same objects as before.
+        self.image = self.rotations.image(self.rot)
+        self.rect.update(rect)
+        self.hit_rect.update(hit_rect)
+        self.game.visible_grid.move(self)
 
     def jump(self, wall_jump, x_direction=None):
         # Jump up.
@@ -65,8 +119,21 @@ class Player(pg.sprite.Sprite):
             # Also jump away from the wall if it is a wall jump.
             self.vel.x = PLAYER_MOVEMENT["jump"]["wall jump"] * x_direction
 
+    def toggle_movement(self):
+        # Switch between jump and spin movement.
+        if self.movement_type == "jump":
+            self.movement_type = "spin"
+        else:
+            self.movement_type = "jump"
+            # Stand up straight again.
+            self.rot = 0
+            self.rot_vel = 0
+
     def try_jump(self, trigger):
         # Trigger is the action that triggered the jump being called.
+        if self.movement_type != "jump":
+            # Only jump in jump movement.
+            return
         if trigger == "hold":
             # The jump button was held down.
             if not self.jumping and self.on_ground:
@@ -79,18 +146,14 @@ class Player(pg.sprite.Sprite):
                 wall_jump_direction = None
 
                 self.hit_rect.centerx += 1
-                collision = pg.sprite.spritecollide(self, self.game.walls,
-                                                    False,
-                                                    collide_hit_rect_both)
+                collision = self.game.collide_walls(self.hit_rect)
                 self.hit_rect.centerx -= 1
 
                 if collision:
                     wall_jump_direction = -1
                 else:
                     self.hit_rect.centerx -= 1
-                    collision = pg.sprite.spritecollide(self, self.game.walls,
-                                                        False,
-                                                        collide_hit_rect_both)
+                    collision = self.game.collide_walls(self.hit_rect)
                     self.hit_rect.centerx += 1
 
                     if collision:
@@ -102,7 +165,18 @@ class Player(pg.sprite.Sprite):
 
     def apply_keys(self):
         # Get key presses.
-        keys = pg.key.get_pressed()
+        keys = self.game.input.get_pressed()
+
+        if self.movement_type == "spin":
+            # Turn, and move forwards in the direction the player is facing.
+            if keys[K_a] or keys[K_LEFT]:
+                self.rot_acc = PLAYER_MOVEMENT["spin"]["rot acc"]
+            if keys[K_d] or keys[K_RIGHT]:
+                self.rot_acc = -PLAYER_MOVEMENT["spin"]["rot acc"]
+            if keys[K_SPACE]:
+                self.acc += Vec(PLAYER_MOVEMENT["spin"]["acc"],
+                                0).rotate(-self.rot)
+            return
 
         # Apply key presses.
         if keys[K_a] or keys[K_LEFT]:
@@ -115,26 +189,41 @@ class Player(pg.sprite.Sprite):
     def check_force_push(self):
         # Check to see what the player was pushed into, and if they should
         # be killed because of it.
-        hits = pg.sprite.spritecollide(self, self.game.walls, False,
-                                       collide_hit_rect_both)
+        hits = self.game.collide_walls(self.hit_rect)
         if hits:
             # The player was pushed into something they should not be in,
-            # reset their position to the start.
+            # reset their position to the start. The hit rect goes there
+            # too, so the next move is not swept across the map.
             self.pos = Vec(100, 1900)
+            self.hit_rect.center = (self.pos.x, self.pos.y)
 
     def collide_walls(self):
+        # The hit rect is swept from where it was to the new position, one
+        # axis at a time, so moving fast can not skip through a thin wall.
+        # The walls near the whole path are found with one query, and each
+        # axis only tests those.
+        start = self.hit_rect.copy()
+        end = self.hit_rect.copy()
+        end.center = (self.pos.x, self.pos.y)
+        nearby = self.game.collide_walls(start.union(end))
+
         self.hit_rect.centerx = self.pos.x
-        # Find all sprites in the target group that are bring hit.
-        hits = pg.sprite.spritecollide(self, self.game.walls, False,
-                                       collide_hit_rect_both)
+        # Find all walls that are hit on the way to the new x position. The
+        # closest one is where the player stops.
+        hits = sweep_hits(nearby, start, self.hit_rect)
         if hits:
-            if self.vel.x > 0:
+            # The side to stop at is from the way the hit rect moved, which
+            # can differ from the velocity (rounding the position can move
+            # the rect into a wall the player is stopped against). If it did
+            # not move, it is from the velocity.
+            moved = self.hit_rect.x - start.x or self.vel.x
+            if moved > 0:
                 # Moving right, will hit left side.
                 hit = min([hit.hit_rect.left for hit in hits])
                 self.pos.x = hit - self.hit_rect.width / 2
                 self.hit_rect.right = hit
                 self.vel.x = 0
-            elif self.vel.x < 0:
+            elif moved < 0:
                 # Moving left, will hit right side.
                 hit = max([hit.hit_rect.right for hit in hits])
                 self.pos.x = hit + self.hit_rect.width / 2
@@ -149,12 +238,13 @@ class Player(pg.sprite.Sprite):
                     # Wall slide.
                     self.vel.y *= PLAYER_MOVEMENT["jump"]["wall slide"]
 
+        start = self.hit_rect.copy()
         self.hit_rect.centery = self.pos.y
-        # Find all sprites in the target group that are bring hit.
-        hits = pg.sprite.spritecollide(self, self.game.walls, False,
-                                       collide_hit_rect_both)
+        # Find all walls that are hit on the way to the new y position.
+        hits = sweep_hits(nearby, start, self.hit_rect)
         if hits:
-            if self.vel.y > 0:
+            moved = self.hit_rect.y - start.y or self.vel.y
+            if moved > 0:
                 # Moving down, will hit top.
                 hit = min([hit.hit_rect.top for hit in hits])
                 self.pos.y = hit - self.hit_rect.width / 2
@@ -164,7 +254,7 @@ class Player(pg.sprite.Sprite):
                     # Hit the ground again if the gravity is normal.
                     self.on_ground = True
                     self.jumping = False
-            elif self.vel.y < 0:
+            elif moved < 0:
                 # Moving up, will hit bottom.
                 hit = max([hit.hit_rect.bottom for hit in hits])
                 self.pos.y = hit + self.hit_rect.width / 2
@@ -230,14 +320,11 @@ class Player(pg.sprite.Sprite):
             check_direction_amount = 5
             if self.gravity_orientation == 1:
                 self.hit_rect.y += check_direction_amount
-                hits = pg.sprite.spritecollide(self, self.game.moving_walls, False,
-                                               collide_hit_rect_both)
+                hits = self.collide_moving_walls()
                 self.hit_rect.y -= check_direction_amount
             elif self.gravity_orientation == -1:
                 self.hit_rect.y -= check_direction_amount
-                hits = pg.sprite.spritecollide(self, self.game.moving_walls,
-                                               False,
-                                               collide_hit_rect_both)
+                hits = self.collide_moving_walls()
                 self.hit_rect.y += check_direction_amount
             if hits:
                 # Near a platform.
@@ -253,27 +340,44 @@ class Player(pg.sprite.Sprite):
 
         self.rect.center = self.hit_rect.center
 
+    def collide_moving_walls(self):
+        # Moving walls are in the wall grid with the other walls.
+        moving_walls = self.game.moving_walls
+        return [hit for hit in self.game.collide_walls(self.hit_rect)
+                if hit in moving_walls]
+
     def collide_items(self):
-        hits = pg.sprite.spritecollide(self, self.game.items, False,
-                                       collide_hit_rect_both)
+        hits = self.game.collide_items(self.hit_rect)
         if hits:
             for hit in hits:
                 if hit.item_type == "coin":
                     self.game.sounds['coin'].play()
                 hit.destroy()
 
+    def turn(self):
+        # Spin movement rotation, the same way as the movement below.
+        self.rot_acc += self.rot_vel * PLAYER_MOVEMENT["spin"]["friction"]
+        self.rot_vel += self.rot_acc * self.game.dt
+        self.rot = (self.rot + self.rot_vel * self.game.dt + 0.5 *
+                    self.rot_acc * self.game.dt ** 2) % 360
+
     def move(self):
         self.acc = Vec(0, 0)
+        self.rot_acc = 0
 
-        # Apply gravity.
-        self.acc = Vec(0, PLAYER_MOVEMENT["jump"]["gravity"] * self.gravity_orientation)
+        if self.movement_type == "jump":
+            # Apply gravity.
+            self.acc = Vec(0, PLAYER_MOVEMENT["jump"]["gravity"] * self.gravity_orientation)
 
         # Get key presses for movement.
         self.apply_keys()
 
+        if self.movement_type == "spin":
+            self.turn()
+
         # Forward/backwards movement.
         # Apply friction.
-        self.acc += self.vel * PLAYER_MOVEMENT["jump"]["friction"]
+        self.acc += self.vel * PLAYER_MOVEMENT[self.movement_type]["friction"]
         # New velocity after.
         # vf = vi + at
         self.vel = self.vel + self.acc * self.game.dt
@@ -292,11 +396,14 @@ class Player(pg.sprite.Sprite):
         self.collide_items()
 
     def update(self):
+        # Save the position from the last step for interpolated drawing.
+        self.previous_center = self.rect.center
         # Move the player sprite based on the current movement mode type.
         self.move()
 
         # Update the sprite image with the correct positioning.
         self.update_image()
+        self.game.visible_grid.move(self)
 
 
 class Obstacle(pg.sprite.Sprite):
@@ -322,6 +429,9 @@ class Obstacle(pg.sprite.Sprite):
         self.rect = pg.Rect(x, y, width, height)
         self.hit_rect = self.rect
         self.obstacle_type = obstacle_type
+        # Add to the grid used for wall collision.
+        if game.walls in self.groups:
+            game.wall_grid.add(self)
 
 
 class MovingObstacle(Obstacle):
@@ -330,118 +440,118 @@ class MovingObstacle(Obstacle):
         # parent class.
         groups = [game.visible_sprites, game.walls]
         # The image size will be the width and the height.
-        self.image = game.wall_imgs["bridge.png"]
+        self.image = game.assets.image("bridge.png")
         self.image = pg.transform.scale(self.image, (int(width), int(height)))
         # self.image = pg.Surface((width, height))
         image_rect = self.image.get_rect()
         super().__init__(game, x, y, image_rect.width, image_rect.height,
                          obstacle_type, groups)
 
-        # Movement.
-        self.pos = Vec(x, y)
+        # Movement. The movement spec is compiled into a path, and the
+        # position comes from the time along the path.
         self.movement = movement
-        self.parts = [n for n in self.movement['parts']]
-        self.one_way_length = len(self.parts)
-        self.part = 1
-        # If the moving obstacle goes goes back, then copy create a copy of
-        # movement and add it to movement, except reversed.
-        if self.movement['back']:
-            back_part = self.parts.copy()
-            back_part.reverse()
-            self.parts += back_part
-
-        # Movement for the current part.
-        rot = self.movement['parts'][self.parts[self.part - 1]]['rot']
-        self.vel = Vec(
-            self.movement['parts'][self.parts[self.part - 1]]['vel'],
-            0).rotate(-rot)
-        self.distance = self.movement['parts'][self.parts[self.part - 1]][
-            'distance']
-        # The starting position for each movement part.
-        self.start_pos = Vec(x, y)
-        self.end_pos = Vec(self.start_pos.x, self.start_pos.y) + Vec(
-            self.distance, 0).rotate(-rot)
+        self.path = compile_movement(movement)
+        self.origin = Vec(x, y)
+        self.pos = Vec(x, y)
+        self.vel = Vec(0, 0)
+        self.time = 0
+        self.seek(0)
 
         # Other data.
         self.game = game
+        game.visible_grid.add(self)
+        # Only move while the area the path covers is near the camera or a
+        # player. Paths that do not go back could be anywhere, so those
+        # always move.
+        area = None
+        if self.path.bounds:
+            left, top, right, bottom = self.path.bounds
+            area = pg.Rect(x + left, y + top, right - left + self.rect.width,
+                           bottom - top + self.rect.height)
+        game.scheduler.add(self, "platforms", area)
+
+    def seek(self, time):
+        # Put the obstacle where it is at a time along its path.
+        self.time = time
+        x, y, vel_x, vel_y = self.path.evaluate(time)
+        self.pos.update(self.origin.x + x, self.origin.y + y)
+        self.vel.update(vel_x, vel_y)
+
+    def place(self):
+        # Move the rects (and the grids) to the position.
+        self.hit_rect.topleft = (self.pos.x, self.pos.y)
+
+        # Update self rect position.
+        self.rect.topleft = self.hit_rect.topleft
+        self.game.wall_grid.move(self)
+        self.game.visible_grid.move(self)
 
     def move(self):
-        # Update position.
-        self.pos += self.vel * self.game.dt
+        # Save the position from the last step for interpolated drawing, and
+        # the top, which players are pushed along x from.
+        self.previous_center = self.rect.center
+        self.previous_top = self.hit_rect.y
 
-        # If the moving obstacle moved onto the player, push the player out
-        # of the way.
-        pos = Vec(self.game.player.pos.x, self.game.player.pos.y)
-        self.collide_player()
-
-        # Update current part of movement if f the moving obstacle moved the
-        # required distance.
-        distance = self.pos - self.start_pos
-        distance = distance.length()
-        if distance >= self.distance:
-            # Set end position, and make sure player is there too.
-            # self.pos = Vec(self.end_pos.x, self.end_pos.y)
-
-            # If all steps are done for the section, go to the next section.
-            if self.part + 1 <= len(self.parts):
-                # Go to the next part if.
-                self.part += 1
-            else:
-                # The final part just finished, so go back to the start.
-                self.part = 1
-            rot = self.movement['parts'][self.parts[self.part - 1]]['rot']
-            self.vel = Vec(
-                self.movement['parts'][self.parts[self.part - 1]]['vel'],
-                0).rotate(-rot)
-            self.distance = self.movement['parts'][self.parts[self.part - 1]][
-                'distance']
-            # The starting position for each movement part.
-            self.start_pos = Vec(self.pos.x, self.pos.y)
-            # Make the vel and distance the opposite if it is on the way back.
-            if self.part > self.one_way_length:
-                self.vel *= -1
-                self.end_pos = Vec(self.start_pos.x, self.start_pos.y) - Vec(
-                    self.distance, 0).rotate(-rot)
-            else:
-                self.end_pos = Vec(self.start_pos.x, self.start_pos.y) + Vec(
-                    self.distance, 0).rotate(-rot)
+        # Update position. The time comes from the number of steps since the
+        # level started, so it does not drift, and is right after sleeping.
+        self.seek(self.game.level_steps * self.game.dt)
+        self.place()
 
         # Wrap around the screen.
         # screen_wrap(self)
 
-    def collide_player(self):
-        self.hit_rect.x = self.pos.x
-        # Test if a player was hit.
-        collision = pg.sprite.spritecollide(self, self.game.players, False,
-                                            collide_hit_rect_both)
+    def wake(self):
+        # Catch up to where the obstacle was at the last step, after it was
+        # not moving while far from the camera.
+        self.seek((self.game.level_steps - 1) * self.game.dt)
+        self.place()
 
-        if collision:
-            player = collision[0]
+    def update(self):
+        # Platforms are updated before the other sprites, see Game.update.
+        self.move()
+
+    def snapshot(self):
+        # The position comes from the time along the path.
+        return (self.time, getattr(self, "previous_center", None),
+                getattr(self, "previous_top", None))
+
+    def restore(self, state):
+        time, self.previous_center, self.previous_top = state
+        self.seek(time)
+        self.place()
+
+    def push_player(self, player):
+        # If the moving obstacle moved onto the player, push the player out
+        # of the way. The obstacle moved along x first (still at its last
+        # y position), then along y. Returns True if the player was pushed.
+        pushed = False
+        hit_rect = self.hit_rect.copy()
+        hit_rect.y = self.previous_top
+        # Test if the player was hit.
+        if hit_rect.colliderect(player.hit_rect):
+            pushed = True
 
             # Push the player to the correct side of the platform and change
             # the player's velocity.
             if self.vel.x > 0:
                 # Moving right, place player on right side.
-                player.pos.x = self.hit_rect.right + player.hit_rect.width / 2
-                player.hit_rect.left = self.hit_rect.right
+                player.pos.x = hit_rect.right + player.hit_rect.width / 2
+                player.hit_rect.left = hit_rect.right
                 # player.vel.x = 0
                 # player.pos.x += self.vel.x * self.game.dt
             elif self.vel.x < 0:
                 # Moving left, place player on left side.
-                player.pos.x = self.hit_rect.left - player.hit_rect.width / 2
-                player.hit_rect.right = self.hit_rect.left
+                player.pos.x = hit_rect.left - player.hit_rect.width / 2
+                player.hit_rect.right = hit_rect.left
                 # player.vel.x = 0
                 # player.pos.x += self.vel.x * self.game.dt
 
             # Update player rect.
-            player.rect = player.hit_rect
+            player.rect.center = player.hit_rect.center
 
-        self.hit_rect.y = self.pos.y
-        # Test if a player was hit.
-        collision = pg.sprite.spritecollide(self, self.game.players, False,
-                                            collide_hit_rect_both)
-        if collision:
-            player = collision[0]
+        # Test if the player was hit.
+        if self.hit_rect.colliderect(player.hit_rect):
+            pushed = True
 
             # Push the player to the correct side of the platform and change
             # the player's velocity.
@@ -462,18 +572,9 @@ class MovingObstacle(Obstacle):
             player.pos.x += self.vel.x * self.game.dt
 
             # Update player rect.
-            player.rect = player.hit_rect
+            player.rect.center = player.hit_rect.center
 
-        # Update self rect position.
-        self.rect.topleft = self.hit_rect.topleft
-
-        # Check to see if the player was pushed into anything they shouldn't
-        # be in.
-        self.game.player.check_force_push()
-
-    def update(self):
-        # Move the obstacle around.
-        self.move()
+        return pushed
 
 
 class Item(pg.sprite.Sprite):
@@ -481,11 +582,7 @@ class Item(pg.sprite.Sprite):
         self.groups = game.all_sprites, game.visible_sprites, game.items
         pg.sprite.Sprite.__init__(self, self.groups)
         # Image.
-        if item_type == "coin":
-            item_img = "coinGold.png"
-        else:
-            item_img = "coinGold.png"
-        self.image = game.item_imgs[item_img]
+        self.image = game.assets.image(item_image(item_type))
         self.rect = self.image.get_rect()
         self.hit_rect = self.rect
         self.rect.center = pos
@@ -494,26 +591,45 @@ class Item(pg.sprite.Sprite):
         self.game = game
         self.item_type = item_type
         self.pos = pos
-        # Item bob animation.
-        self.tween = easeInOutSine
+        # Item bob animation. The offset for every step is in a table that
+        # is shared by the items that start at the same step, so the item is
+        # only moved when it is drawn or hit (see catch_up).
         if random_start_step:
-            self.step = randint(0, BOB_RANGE)
+            self.bob = bob_table(randint(0, BOB_RANGE))
         else:
-            self.step = 0
-        self.direction = 1
+            self.bob = bob_table(0)
+        # Level step that the rect is at.
+        self.bob_steps = 0
         # Debug.
         self.color = YELLOW
-
-    def update(self):
-        # bobbing motion (subtract 0.5 to shift halfway)
-        offset = BOB_RANGE * (self.tween(self.step / BOB_RANGE) - 0.5)
-        self.rect.centery = self.pos.y + offset * self.direction
-        self.step += BOB_SPEED
-        # switch and reset if hit maximum
-        if self.step > BOB_RANGE:
-            self.step = 0
-            self.direction *= -1
+        # Add to the grids used for item collision and drawing.
+        game.item_grid.add(self)
+        game.visible_grid.add(self)
+
+    def catch_up(self):
+        # Move the item to where its bob animation is after the number of
+        # simulation steps since the level started. Items are not moved every
+        # step, they catch up when they are drawn or hit.
+        clock = self.game.level_steps
+        if clock == self.bob_steps:
+            return
+        self.bob_steps = clock
+        # Save the position from the last step for interpolated drawing.
+        if clock > 1:
+            self.rect.centery = self.pos.y + self.bob.offset(clock - 2)
+        else:
+            self.rect.centery = self.pos.y
+        self.previous_center = self.rect.center
+        self.rect.centery = self.pos.y + self.bob.offset(clock - 1)
 
     def destroy(self):
         # Remove the item.
         self.kill()
+        self.game.item_grid.remove(self)
+        self.game.visible_grid.remove(self)
+
+    def revive(self):
+        # Put a destroyed item back, when a level is restored.
+        self.add(self.groups)
+        self.game.item_grid.add(self)
+        self.game.visible_grid.add(self)
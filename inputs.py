@@ -0,0 +1,127 @@
+import json
+import warnings
+import pygame as pg
+from pygame.locals import *
+
+
+class KeyState:
+    # Key state with the same indexing as pg.key.get_pressed().
+    def __init__(self, held=()):
+        self.held = frozenset(held)
+
+    def __getitem__(self, key):
+        return key in self.held
+
+
+class InputSource:
+    # Where the game gets its input from. next_frame is called at the start
+    # of every frame, then the events and key states are read, then
+    # frame_steps simulation steps are run (headless games only) with
+    # end_step called after each one, then end_frame is called with the
+    # number of steps that were run.
+    finished = False
+    frame_steps = 1
+
+    def next_frame(self):
+        pass
+
+    def get_events(self):
+        return []
+
+    def get_pressed(self):
+        return KeyState()
+
+    def end_step(self, game):
+        pass
+
+    def end_frame(self, steps):
+        pass
+
+
+class KeyboardInput(InputSource):
+    # Live input from the keyboard and the window.
+    def get_events(self):
+        return pg.event.get()
+
+    def get_pressed(self):
+        return pg.key.get_pressed()
+
+
+class ScriptedInput(InputSource):
+    # Input from a script instead of the keyboard, for running the game
+    # without a display. The script is a list of steps:
+    #   {"held": ["d", "space"], "pressed": ["g"], "frames": 30}
+    # where "held" keys are down for every frame of the step, and "pressed"
+    # keys get a KEYDOWN event on the first frame of the step. Keys can be
+    # pygame key codes or key names. The script can also be a function that
+    # takes the frame number and returns (held, pressed), or None to end.
+    def __init__(self, script, loop=False):
+        self.loop = loop
+        self.frame = -1
+        self.finished = False
+        if callable(script):
+            self.function = script
+            self.frames = None
+        else:
+            self.function = None
+            self.frames = []
+            for step in script:
+                held = KeyState(key_code(key) for key in step.get("held", ()))
+                pressed = [key_code(key) for key in step.get("pressed", ())]
+                self.frames.append((held, pressed))
+                for _ in range(step.get("frames", 1) - 1):
+                    self.frames.append((held, []))
+        self.held = KeyState()
+        self.pressed = []
+
+    @classmethod
+    def from_file(cls, filename, loop=False):
+        with open(filename) as file:
+            return cls(json.load(file), loop)
+
+    def next_frame(self):
+        self.frame += 1
+        if self.function:
+            frame_input = self.function(self.frame)
+            if frame_input is None:
+                self.finished = True
+                frame_input = ((), ())
+            held, pressed = frame_input
+            self.held = KeyState(key_code(key) for key in held)
+            self.pressed = [key_code(key) for key in pressed]
+        else:
+            if self.frame >= len(self.frames):
+                if self.loop and self.frames:
+                    self.frame = 0
+                else:
+                    self.finished = True
+                    self.held, self.pressed = KeyState(), []
+                    return
+            self.held, self.pressed = self.frames[self.frame]
+
+    def get_events(self):
+        return [pg.event.Event(KEYDOWN, key=key) for key in self.pressed]
+
+    def get_pressed(self):
+        return self.held
+
+
+def key_code(key):
+    # Key names are pygame key names ("a", "space", "left shift"), or the
+    # names of the pygame key constants without K_ ("LSHIFT").
+    if isinstance(key, str):
+        try:
+            # Scripts can be read before pygame is initialized, which the
+            # name lookup does not need.
+            with warnings.catch_warnings():
+                warnings.simplefilter("ignore")
+                return pg.key.key_code(key)
+        except ValueError:
+            pass
+        code = getattr(pg, "K_" + key, None)
+        if code is None:
+            code = getattr(pg, "K_" + key.upper(), None)
+        if code is None:
+            raise ValueError(f"Unknown key name: {key}")
+        return code
+    return key
@@ -1,24 +1,77 @@
 import os
+import math
+import time
+import random
+import argparse
 import pygame as pg
 from pygame.locals import *
 from settings import *
 from tilemap import Camera, TiledMap
+from spatial import SpatialGrid, merge_rects
+from occupancy import OccupancyGrid
+from scheduler import UpdateScheduler
+from store import WallStore, ItemStore
+from text import TextRenderer
+from rotation import RotationCache
+from assets import AssetManager, LazySound
+from pack import open_pack
+from watcher import FolderWatcher
+from mapcache import load_map_data, source_files
+from profiler import Profiler
+from inputs import KeyboardInput, ScriptedInput
+from replay import InputRecorder, InputReplayer
 from entities import *
 
 
+class SilentSound:
+    # Stands in for a sound when there is no audio.
+    def play(self, *args, **kwargs):
+        pass
+
+    def set_volume(self, volume):
+        pass
+
+
 class Game:
-    def __init__(self):
+    def __init__(self, headless=False, input_source=None, max_steps=None,
+                 entity_backend=ENTITY_BACKEND):
+        # Headless games have no display, no audio and are not limited to
+        # FPS. They run the simulation as fast as possible with input from
+        # input_source, for at most max_steps steps.
+        self.headless = headless
+        self.max_steps = max_steps
+        # How items and static walls are stored, "sprites" or "arrays".
+        self.entity_backend = entity_backend
+        if input_source is None:
+            input_source = KeyboardInput()
+        self.input = input_source
+
         # Initialize pygame.
-        pg.mixer.pre_init(44100, -16, 1, 2048)
-        pg.init()
-        pg.mixer.init()
+        if headless:
+            os.environ["SDL_VIDEODRIVER"] = "dummy"
+            os.environ["SDL_AUDIODRIVER"] = "dummy"
+            pg.init()
+            # No audio.
+            pg.mixer.quit()
+        else:
+            pg.mixer.pre_init(44100, -16, 1, 2048)
+            pg.init()
+            pg.mixer.init()
 
         # Display
         pg.display.set_caption(TITLE)
-        self.screen = pg.display.set_mode(
-            (SCREEN_WIDTH, SCREEN_HEIGHT), FULLSCREEN)
+        if headless:
+            # A display mode is still needed to convert images.
+            self.screen = pg.display.set_mode((SCREEN_WIDTH, SCREEN_HEIGHT))
+        else:
+            self.screen = pg.display.set_mode(
+                (SCREEN_WIDTH, SCREEN_HEIGHT), FULLSCREEN)
         self.show_fps = False
         self.debug = False
+        # Fonts and rendered text for draw_text.
+        self.text = TextRenderer(open_font=self.open_asset)
+        # Frame timing.
+        self.profiler = Profiler()
 
         # Sprites groups.
         self.all_sprites = pg.sprite.Group()
@@ -30,12 +83,29 @@ class Game:
 
         # Game loop.
         self.clock = pg.time.Clock()
+        # Fixed simulation step, and how far drawing is between the last
+        # simulation step and the next one.
+        self.dt = 1 / SIM_RATE
+        self.alpha = 1
         self.running = True
         self.playing = True
+        # Snapshots of the level when it started and at the last checkpoint.
+        self.start_state = None
+        self.checkpoint = None
 
         self.player_pos = []
 
         self.camera_update = True
+        # Number of sprites drawn and skipped (off the screen) last frame.
+        self.drawn_sprites = 0
+        self.culled_sprites = 0
+        # Dirty rect drawing only redraws the parts of the screen that
+        # changed while the camera is still. The last frame's camera
+        # position, sprite rects and overlay area are kept to find them.
+        self.dirty_rects = DIRTY_RECTS
+        self.drawn_camera = None
+        self.drawn_rects = {}
+        self.overlay_rect = pg.Rect(0, 0, 0, 0)
 
         # Load data from files.
         self.load()
@@ -47,40 +117,46 @@ class Game:
         img_folder = os.path.join(game_folder, "img")
         snd_folder = os.path.join(game_folder, "snd")
         self.map_folder = os.path.join(game_folder, "map")
+        # Watches the map folder for maps being saved, to reload the level.
+        self.map_watcher = None
+        if HOT_RELOAD and not self.headless:
+            self.map_watcher = FolderWatcher(self.map_folder)
+        # Maps that were reloaded, which are loaded from their files from
+        # then on instead of the (older) asset pack.
+        self.edited_maps = set()
+
+        # Assets are loaded from the asset pack while there is one (see
+        # pack.py), otherwise from their files.
+        self.pack = open_pack(os.path.join(game_folder, ASSET_PACK))
+        self.assets = AssetManager(self.pack)
 
         # App icon.
-        self.icon = pg.image.load(os.path.join(img_folder, GAME_IMG))
+        self.icon = self.assets.decode_image(
+            os.path.join(img_folder, GAME_IMG))
         pg.display.set_icon(self.icon)
 
-        # Sprite images.
-        self.player_imgs = {}
-        for filename in PLAYER_IMGS:
-            new_img = pg.image.load(
-                os.path.join(img_folder, filename)).convert_alpha()
-            # Rotate so the sprite moves in the direction it is pointing.
-            self.player_imgs[filename] = new_img
-            # self.player_imgs[filename] = pg.transform.rotate(new_img, 90)
-
-        # Wall images.
-        self.wall_imgs = {}
-        for filename in WALL_IMGS:
-            new_img = pg.image.load(
-                os.path.join(img_folder, filename)).convert_alpha()
-            self.wall_imgs[filename] = new_img
-
-        # Item images.
-        self.item_imgs = {}
-        for filename in ITEM_IMGS:
-            new_img = pg.image.load(
-                os.path.join(img_folder, filename)).convert_alpha()
-            self.item_imgs[filename] = new_img
-
-        # Sounds.
+        # Images and sounds are decoded in the background while the start
+        # screen shows, and finished by finish_loading.
+        for filename in PLAYER_IMGS + WALL_IMGS + ITEM_IMGS:
+            self.assets.load_image(filename,
+                                   os.path.join(img_folder, filename))
+        # The player images rotated to every angle for spin movement, made
+        # when loading finishes.
+        self.player_rotations = {}
+        self.loaded = False
+        # Images used by the current level.
+        self.level_images = set()
+
+        # Sounds. Rarely used sounds are loaded the first time they play.
         self.sounds = {}
         for sound_type, filename in SOUNDS.items():
-            new_snd = pg.mixer.Sound(os.path.join(snd_folder, filename))
-            new_snd.set_volume(0.1)
-            self.sounds[sound_type] = new_snd
+            path = os.path.join(snd_folder, filename)
+            if self.headless:
+                self.sounds[sound_type] = SilentSound()
+            elif sound_type in LAZY_SOUNDS:
+                self.sounds[sound_type] = LazySound(self.assets, path, 0.1)
+            else:
+                self.assets.load_sound(sound_type, path, 0.1)
 
         # Music.
         self.game_music = os.path.join(snd_folder, GAME_BG_MUSIC)
@@ -88,16 +164,76 @@ class Game:
         # Text font.
         self.theme_font = os.path.join(font_folder, THEME_FONT)
 
+    def finish_loading(self, progress=None):
+        # Wait for the assets to load, calling progress(done, total) while
+        # waiting.
+        if self.loaded:
+            return
+        self.assets.wait(progress)
+        self.sounds.update(self.assets.sounds)
+        # The player is in every level, so its images are never freed.
+        self.assets.acquire(PLAYER_IMGS)
+        for filename in PLAYER_IMGS:
+            # Rotate so the sprite moves in the direction it is pointing.
+            # self.assets.images[filename] = pg.transform.rotate(
+            #     self.assets.image(filename), 90)
+            self.player_rotations[filename] = RotationCache(
+                self.assets.image(filename))
+        self.loaded = True
+
+    def open_asset(self, filename):
+        # A font or music file, from the asset pack if it is in it.
+        return self.assets.open(filename)
+
     def create_map(self, filename):
         # Basic map background image with data.
-        self.map = TiledMap(os.path.join(self.map_folder, filename))
+        path = os.path.join(self.map_folder, filename)
+        map_data = None
+        if self.pack is not None and path in self.pack and \
+                os.path.normpath(path) not in self.edited_maps:
+            map_data = self.pack.map_data(path)
+        self.create_level(TiledMap(path, map_data=map_data))
+
+    def create_level(self, tiled_map):
+        # Create the sprites for a loaded map.
+        self.map = tiled_map
         self.map.make_map()
 
+        # Remove the sprites from the last level.
+        for group in (self.all_sprites, self.players, self.visible_sprites,
+                      self.walls, self.moving_walls, self.items):
+            group.empty()
+
+        self.finish_loading()
+        self.use_level_images()
+
+        # Snapshots are of the last level.
+        self.start_state = None
+        self.checkpoint = None
+
+        # Simulation steps since the level started. The moving platforms and
+        # the item bob animation go by this.
+        self.level_steps = 0
+        # The sprites that are updated each step. Platforms move first, then
+        # the other sprites (the players) update.
+        self.scheduler = UpdateScheduler(["platforms", "sprites"])
+
+        # Spatial grids for collision with the map objects.
+        self.wall_grid = SpatialGrid()
+        self.item_grid = SpatialGrid()
+        # Spatial grid for finding the sprites that are on the screen.
+        self.visible_grid = SpatialGrid(DRAW_CELL_SIZE, "rect")
+        # Solid tiles from the tile layers.
+        self.solid_tiles = None
+        if TILE_COLLISION:
+            self.solid_tiles = OccupancyGrid.from_map(self.map)
+
         # Create the camera with the map dimensions.
         self.camera = Camera(SCREEN_WIDTH, SCREEN_HEIGHT,
                              self.map.width, self.map.height)
 
-        movement = {
+        # Movement of the moving platforms.
+        self.platform_movement = {
             "back": True,
             "parts": {
                 1: {
@@ -118,50 +254,417 @@ class Game:
             }
             }
 
-        # Map objects.
-        for tile_object in self.map.tilemap_data.objects:
-            # The center of the tile.
-            object_center = Vec(tile_object.x + tile_object.width / 2, tile_object.y + tile_object.height / 2)
-            # Obstacles.
-            if tile_object.object == "obstacle":
-                Obstacle(self, tile_object.x, tile_object.y,
-                         tile_object.width, tile_object.height,
-                         tile_object.type)
-            elif tile_object.object == "moving_obstacle":
-                MovingObstacle(self, tile_object.x, tile_object.y,
-                               tile_object.width, tile_object.height,
-                               tile_object.type, movement)
+        # Map objects. The sprites made for each object are kept by object
+        # id, so the level can be updated when the map is reloaded.
+        self.wall_store = None
+        self.item_store = None
+        self.merged_walls = []
+        self.build_static_walls()
+        self.object_sprites = {}
+        for tile_object in self.map.objects:
+            sprite = self.create_object(tile_object)
+            if sprite is not None:
+                self.object_sprites[tile_object.id] = sprite
+        # Every item sprite, so collected ones can be put back when the level
+        # is restored.
+        self.level_items = list(self.items)
+        self.build_item_store()
+        self.update_platform_reach()
+
+    def use_level_images(self):
+        # Keep the images this level uses, and free the ones only the last
+        # level (or the last version of the map) used.
+        level_images = set()
+        for tile_object in self.map.objects:
+            if tile_object.object == "moving_obstacle":
+                level_images.add("bridge.png")
             elif tile_object.object == "item":
-                Item(self, object_center, tile_object.type, RANDOM_START_STEP)
+                level_images.add(item_image(tile_object.type))
+        self.assets.acquire(level_images)
+        self.assets.release(self.level_images)
+        self.level_images = level_images
+        self.assets.collect()
+
+    def use_stores(self):
+        # With the array backend, static walls and items are kept in stores
+        # instead of being sprites.
+        return self.entity_backend == "arrays"
+
+    def build_static_walls(self):
+        # Static walls are merged into as few rects as possible, so there
+        # are fewer to collide with and no seams between them. The original
+        # rects are kept for debug drawing.
+        self.wall_objects = [pg.Rect(tile_object.x, tile_object.y,
+                                     tile_object.width, tile_object.height)
+                             for tile_object in self.map.objects
+                             if tile_object.object == "obstacle" and
+                             tile_object.type == "wall"]
+        wall_rects = self.wall_objects
+        if MERGE_WALLS:
+            wall_rects = merge_rects(self.wall_objects)
+        # Remove the walls from before the map was reloaded.
+        for wall in self.merged_walls:
+            self.remove_sprite(wall)
+        self.merged_walls = []
+        if self.use_stores():
+            self.wall_store = WallStore(wall_rects)
+        elif MERGE_WALLS:
+            self.merged_walls = [Obstacle(self, rect.x, rect.y, rect.width,
+                                          rect.height, "wall")
+                                 for rect in wall_rects]
+
+    def build_item_store(self, collected=()):
+        # Items for the array backend, with the ones with the collected
+        # object ids already collected.
+        if not self.use_stores():
+            return
+        item_objects = [tile_object for tile_object in self.map.objects
+                        if tile_object.object == "item"]
+        item_types = [tile_object.type for tile_object in item_objects]
+        self.item_store = ItemStore(
+            {item_type: self.assets.image(item_image(item_type))
+             for item_type in item_types},
+            [Vec(tile_object.x + tile_object.width / 2,
+                 tile_object.y + tile_object.height / 2)
+             for tile_object in item_objects],
+            item_types,
+            [random.randint(0, BOB_RANGE) if RANDOM_START_STEP else 0
+             for tile_object in item_objects])
+        self.item_store.set_clock(self.level_steps)
+        # Object id of each item in the store.
+        self.store_item_ids = [tile_object.id for tile_object in item_objects]
+        for index, object_id in enumerate(self.store_item_ids):
+            if object_id in collected:
+                self.item_store.destroy(index)
+
+    def create_object(self, tile_object):
+        # Make the sprite for a map object. Returns None for the objects
+        # without one, and the static walls and items that are built all at
+        # once (see build_static_walls and build_item_store).
+        # The center of the tile.
+        object_center = Vec(tile_object.x + tile_object.width / 2, tile_object.y + tile_object.height / 2)
+        # Obstacles.
+        if tile_object.object == "obstacle" and \
+                tile_object.type == "wall" and \
+                (MERGE_WALLS or self.use_stores()):
+            # Built with the other static walls.
+            return None
+        elif tile_object.object == "obstacle":
+            return Obstacle(self, tile_object.x, tile_object.y,
+                            tile_object.width, tile_object.height,
+                            tile_object.type)
+        elif tile_object.object == "moving_obstacle":
+            return MovingObstacle(self, tile_object.x, tile_object.y,
+                                  tile_object.width, tile_object.height,
+                                  tile_object.type, self.platform_movement)
+        elif tile_object.object == "item" and self.use_stores():
+            return None
+        elif tile_object.object == "item":
+            return Item(self, object_center, tile_object.type,
+                        RANDOM_START_STEP)
+        return None
+
+    def check_map_changes(self):
+        # Reload the level if its map file (or a tileset image it uses) was
+        # saved.
+        changed = self.map_watcher.poll()
+        if not changed:
+            return
+        filename = self.map.filename
+        start = time.perf_counter()
+        try:
+            sources = {os.path.normpath(path) for path in
+                       source_files(filename)}
+            changed = [path for path in changed
+                       if os.path.normpath(path) in sources]
+            if not changed:
+                return
+            map_data = load_map_data(filename)
+        except (OSError, ValueError, KeyError, SyntaxError) as error:
+            # Probably saved half way, it is loaded on the next save.
+            print(f"Could not reload {filename}: {error}")
+            return
+        images_changed = any(os.path.normpath(path) !=
+                             os.path.normpath(filename) for path in changed)
+        self.reload_map(map_data, images_changed)
+        print(f"Reloaded {os.path.basename(filename)} in "
+              f"{(time.perf_counter() - start) * 1000:.0f} ms")
+
+    def reload_map(self, map_data, images_changed=False):
+        # Update the level to a new version of its map, only changing what
+        # is different: the chunks with tiles that changed, and the sprites
+        # of the objects that were added, removed or changed (by object id).
+        # The players keep their state.
+        tiled_map = self.map
+        self.edited_maps.add(os.path.normpath(tiled_map.filename))
+        # The snapshots have the sprites from before, so restarting makes
+        # the level again.
+        self.start_state = None
+        self.checkpoint = None
+        if (map_data.width, map_data.height, map_data.tilewidth,
+                map_data.tileheight) != (tiled_map.columns, tiled_map.rows,
+                                         tiled_map.tilewidth,
+                                         tiled_map.tileheight):
+            # The map size changed, so make the whole level again.
+            state = self.player.snapshot()
+            self.create_level(TiledMap(tiled_map.filename, map_data=map_data))
+            self.create_player(0, 0)
+            self.player.restore(state[:-1] + (None,))
+            return
+
+        # Tiles.
+        tiled_map.update_tiles(map_data, images_changed)
+        if TILE_COLLISION:
+            self.solid_tiles = OccupancyGrid.from_map(tiled_map)
+
+        # Objects.
+        old_objects = {tile_object.id: tile_object
+                       for tile_object in tiled_map.objects}
+        new_objects = {tile_object.id: tile_object
+                       for tile_object in map_data.objects}
+        changed = {object_id for object_id in old_objects.keys() |
+                   new_objects.keys()
+                   if object_id not in old_objects or
+                   object_id not in new_objects or
+                   old_objects[object_id].to_record() !=
+                   new_objects[object_id].to_record()}
+        tiled_map.objects = map_data.objects
+        changed_objects = [old_objects[object_id] for object_id in changed
+                           if object_id in old_objects] + \
+            [new_objects[object_id] for object_id in changed
+             if object_id in new_objects]
+        for object_id in changed:
+            sprite = self.object_sprites.pop(object_id, None)
+            if sprite is not None:
+                self.remove_sprite(sprite)
+        self.use_level_images()
+        for tile_object in map_data.objects:
+            if tile_object.id in changed:
+                sprite = self.create_object(tile_object)
+                if sprite is not None:
+                    self.object_sprites[tile_object.id] = sprite
+                    if isinstance(sprite, Item):
+                        self.level_items.append(sprite)
+        if any(tile_object.object == "obstacle" and
+               tile_object.type == "wall" for tile_object in changed_objects):
+            self.build_static_walls()
+        if self.item_store is not None and \
+                any(tile_object.object == "item"
+                    for tile_object in changed_objects):
+            # Items that were collected stay collected.
+            self.build_item_store(
+                {object_id for index, object_id in
+                 enumerate(self.store_item_ids)
+                 if not self.item_store.alive[index]})
+        self.update_platform_reach()
+        # Draw the whole screen again.
+        self.drawn_camera = None
+
+    def remove_sprite(self, sprite):
+        # Take a map object's sprite out of the level.
+        sprite.kill()
+        self.wall_grid.remove(sprite)
+        self.item_grid.remove(sprite)
+        self.visible_grid.remove(sprite)
+        self.scheduler.remove(sprite)
+        if sprite in self.level_items:
+            self.level_items.remove(sprite)
+        for player in self.players:
+            if player.moving_obstacle is sprite:
+                player.moving_obstacle = None
+
+    def update_platform_reach(self):
+        # How far a moving platform can go in one step. Players within this
+        # distance of a platform may have been moved into by it.
+        self.platform_reach = 0
+        if self.moving_walls:
+            self.platform_reach = math.ceil(max(
+                wall.path.max_speed for wall in self.moving_walls) * self.dt)
 
     def new(self):
-        # Create the map.
-        self.create_map("map1.tmx")
+        if self.start_state is None:
+            # Create the map.
+            self.create_map("map1.tmx")
 
-        # Create the player object.
-        self.player = Player(self, 100, 1800, "playerimg.png")
+            # Create the player object.
+            self.create_player(100, 1800)
+            self.start_state = self.snapshot()
 
-        # Start playing the background music.
-        pg.mixer.music.load(self.game_music)
-        pg.mixer.music.set_volume(0.1)
-        pg.mixer.music.play(loops=-1)
+            # Start playing the background music.
+            if not self.headless:
+                pg.mixer.music.load(self.open_asset(self.game_music),
+                                    os.path.splitext(self.game_music)[1][1:])
+                pg.mixer.music.set_volume(0.1)
+                pg.mixer.music.play(loops=-1)
+        else:
+            # Play the level again from the start, without making it again.
+            self.restore(self.start_state)
+        self.checkpoint = None
 
         # Start running the game..
         self.run()
 
+    def snapshot(self):
+        # The state of the level simulation, which restore puts back in
+        # place without making any sprites or surfaces. Restarts and
+        # checkpoints restore snapshots, and replays can seek with them.
+        return {
+            "level_steps": self.level_steps,
+            "camera": self.camera.snapshot(),
+            "scheduler": self.scheduler.snapshot(),
+            "players": {player: player.snapshot() for player in self.players},
+            "platforms": {wall: wall.snapshot() for wall in
+                          self.moving_walls},
+            "items": {item for item in self.level_items if item.alive()},
+            "item_store": None if self.item_store is None else
+            self.item_store.snapshot()
+        }
+
+    def restore(self, snapshot):
+        self.level_steps = snapshot["level_steps"]
+        self.scheduler.restore(snapshot["scheduler"])
+        for wall, state in snapshot["platforms"].items():
+            wall.restore(state)
+        # Put back the collected items, and collect the ones that were
+        # collected when the snapshot was made.
+        alive = snapshot["items"]
+        for item in self.level_items:
+            if item in alive:
+                if not item.alive():
+                    item.revive()
+            elif item.alive():
+                item.destroy()
+        if self.item_store is not None:
+            self.item_store.restore(snapshot["item_store"])
+        for player, state in snapshot["players"].items():
+            player.restore(state)
+        self.camera.restore(snapshot["camera"])
+        # Draw the whole screen again.
+        self.drawn_camera = None
+
+    def collide_walls(self, rect):
+        # Walls and solid tiles that overlap the rect.
+        hits = self.wall_grid.collide(rect)
+        if self.wall_store is not None:
+            hits += self.wall_store.collide(rect)
+        if self.solid_tiles is not None:
+            hits += self.solid_tiles.collide(rect)
+        return hits
+
+    def collide_items(self, rect):
+        # Items that overlap the rect. The items near it are moved to where
+        # their bob animation is first. Items are in the grid where they
+        # start, so the query reaches as far as they can bob from there.
+        hits = []
+        bob = BOB_RANGE // 2 + 1
+        for item in self.item_grid.query(rect.inflate(0, bob * 2)):
+            item.catch_up()
+            if item.hit_rect.colliderect(rect):
+                hits.append(item)
+        if self.item_store is not None:
+            hits += self.item_store.collide(rect)
+        return hits
+
+    def create_player(self, x, y):
+        self.player = Player(self, x, y, "playerimg.png")
+        # Start with the camera on the player, it may be drawn before the
+        # first simulation step.
+        self.camera.update(self.player)
+
     def run(self):
+        if self.headless:
+            self.run_headless()
+            return
         # Game loop.
         self.playing = True
+        accumulator = 0
+        frames = 0
+        profiler = self.profiler
         while self.playing:
             # Pause.
-            self.dt = self.clock.tick(FPS) / 1000.0
+            accumulator += self.clock.tick(FPS) / 1000.0
+            profiler.start("events")
             self.events()
-            self.update()
+            if self.map_watcher is not None:
+                self.check_map_changes()
+            profiler.stop("events")
+            # Run as many fixed simulation steps as fit in the time that
+            # passed.
+            steps = 0
+            profiler.start("update")
+            while accumulator >= self.dt and steps < MAX_SIM_STEPS:
+                self.update()
+                accumulator -= self.dt
+                steps += 1
+            profiler.stop("update")
+            self.input.end_frame(steps)
+            if accumulator >= self.dt:
+                # Too far behind to catch up, drop the extra time instead of
+                # slowing down even more.
+                accumulator %= self.dt
+            self.alpha = accumulator / self.dt
+            profiler.start("draw")
             self.draw()
+            profiler.stop("draw")
+            self.end_frame_profile(steps)
+            # Update title with information, once a second.
+            frames += 1
+            if frames % FPS == 0:
+                title = TITLE + f" FPS: {round(self.clock.get_fps(), 2)}"
+                pg.display.set_caption(title)
+
+    def run_headless(self):
+        # Game loop without drawing or waiting, one simulation step per
+        # input frame.
+        self.playing = True
+        self.steps = 0
+        start = time.perf_counter()
+        while self.playing:
+            if self.max_steps is not None and self.steps >= self.max_steps:
+                break
+            self.input.next_frame()
+            if self.input.finished:
+                break
+            self.profiler.start("events")
+            self.events()
+            self.profiler.stop("events")
+            self.profiler.start("update")
+            for _ in range(self.input.frame_steps):
+                self.update()
+            self.profiler.stop("update")
+            self.steps += self.input.frame_steps
+            self.input.end_frame(self.input.frame_steps)
+            self.end_frame_profile(self.input.frame_steps)
+        self.elapsed = time.perf_counter() - start
+        self.steps_per_second = self.steps / self.elapsed if self.elapsed \
+            else float("inf")
+        # A headless game plays once.
+        self.running = False
+
+    def end_frame_profile(self, steps):
+        if not self.profiler.enabled:
+            return
+        self.profiler.count("steps", steps)
+        wall_grids = [self.wall_grid]
+        if self.wall_store is not None:
+            wall_grids.append(self.wall_store.grid)
+        item_grids = [self.item_grid]
+        if self.item_store is not None:
+            item_grids.append(self.item_store.grid)
+        self.profiler.count("wall queries",
+                            sum(grid.queries for grid in wall_grids))
+        self.profiler.count("item queries",
+                            sum(grid.queries for grid in item_grids))
+        self.profiler.count("drawn sprites", self.drawn_sprites)
+        self.profiler.count("active sprites", self.scheduler.active_count)
+        self.profiler.count("sleeping sprites", self.scheduler.sleeping_count)
+        for grid in wall_grids + item_grids:
+            grid.queries = 0
+        self.profiler.end_frame()
 
     def events(self):
         # Game events loop.
-        for event in pg.event.get():
+        for event in self.input.get_events():
             # Check for closing window.
             if event.type == QUIT or event.type == KEYDOWN and event.key == \
                     K_ESCAPE:
@@ -178,21 +681,78 @@ class Game:
                 if event.key == K_g:
                     # Change the player gravity up/down.
                     self.player.gravity_orientation *= -1
+                if event.key == K_m:
+                    # Switch between jump and spin movement.
+                    self.player.toggle_movement()
+                if event.key == K_k:
+                    # Save a checkpoint.
+                    self.checkpoint = self.snapshot()
+                if event.key == K_t:
+                    # Go back to the checkpoint, or the start of the level.
+                    state = self.checkpoint or self.start_state
+                    if state is not None:
+                        self.restore(state)
+                    else:
+                        # The map was reloaded, so make the level again.
+                        self.playing = False
                 if event.key == K_c:
                     # Change the player gravity up/down.
                     self.camera_update = not self.camera_update
+                if event.key == K_r:
+                    # Toggle dirty rect drawing.
+                    self.dirty_rects = not self.dirty_rects
+                    self.drawn_camera = None
+                if event.key == K_p:
+                    # Toggle the profiler and its overlay.
+                    self.profiler.toggle()
+                if event.key == K_o:
+                    # Export the profiler data.
+                    self.profiler.export(PROFILER_EXPORT_FILE)
 
     def update(self):
-        # Game update loop.
-        # self.moving_walls.update()
-        # self.players.update()
-        self.all_sprites.update()
+        # Game update loop. The moving platforms move first, then the players
+        # are pushed out of them, then the other sprites update. Only the
+        # sprites near the camera and the players are updated, static walls
+        # and items do not need to be.
+        self.level_steps += 1
+        self.profiler.start("schedule")
+        self.scheduler.update_region(
+            [self.camera.view_rect] +
+            [player.hit_rect for player in self.players])
+        self.profiler.stop("schedule")
+        self.profiler.start("move platforms")
+        self.scheduler.update("platforms", self.profiler)
+        self.profiler.stop("move platforms")
+        self.profiler.start("platform contacts")
+        self.resolve_platform_contacts()
+        self.profiler.stop("platform contacts")
+        if self.item_store is not None:
+            self.item_store.update()
+        self.scheduler.update("sprites", self.profiler)
+        self.input.end_step(self)
         # Make the camera center on the player sprite.
         if self.camera_update:
             self.camera.update(self.player)
-        # Update title with information.
-        title = TITLE + f" FPS: {round(self.clock.get_fps(), 2)}"
-        pg.display.set_caption(title)
+        else:
+            self.camera.hold()
+
+    def resolve_platform_contacts(self):
+        # Push each player out of the platforms that moved into them, all in
+        # one pass after every platform has moved. Only the platforms near
+        # the player are tested, found with one wall grid query. A player
+        # that was pushed into a wall is crushed.
+        if not self.platform_reach:
+            return
+        moving_walls = self.moving_walls
+        for player in self.players:
+            area = player.hit_rect.inflate(self.platform_reach * 2,
+                                           self.platform_reach * 2)
+            pushed = False
+            for wall in self.wall_grid.query(area):
+                if wall in moving_walls and wall.push_player(player):
+                    pushed = True
+            if pushed:
+                player.check_force_push()
 
     def draw_grid(self):
         # A grid of lines to represent the tiles of the map. The grid will
@@ -216,25 +776,151 @@ class Game:
         # Grid of tiles.
         self.draw_grid()
 
+        # Draw the solid tiles on the screen.
+        if self.solid_tiles is not None:
+            for tile in self.solid_tiles.collide(self.camera.view_rect):
+                pg.draw.rect(self.screen, GREEN,
+                             self.camera.apply_rect(tile.rect), 1)
+
+        # Draw the walls as they are in the map, before they were merged.
+        for rect in self.wall_objects:
+            pg.draw.rect(self.screen, DARKGRAY, self.camera.apply_rect(rect), 1)
+
         # Draw wall boundaries.
         for sprite in self.all_sprites:
             self.draw_boundary(sprite, sprite.color)
+        if self.wall_store is not None:
+            for wall in self.wall_store.collide(self.camera.view_rect):
+                self.draw_boundary(wall, wall.color)
+        if self.item_store is not None:
+            for item in self.item_store.views.values():
+                self.draw_boundary(item, item.color)
+
+    def sprites_on_screen(self):
+        # Only sprites in the drawing grid cells around the screen are
+        # checked, and only the ones on the screen are drawn. Returns the
+        # sprites with their screen positions, in drawing order.
+        view = self.camera.view_rect
+        candidates = self.visible_grid.query(view.inflate(DRAW_MARGIN * 2,
+                                                          DRAW_MARGIN * 2))
+        # Items only move when they are drawn or hit.
+        items = self.items
+        for sprite in candidates:
+            if sprite in items:
+                sprite.catch_up()
+        on_screen = [sprite for sprite in candidates
+                     if sprite.rect.colliderect(view)]
+        visible = len(self.visible_sprites)
+        if self.item_store is not None:
+            on_screen += self.item_store.on_screen(view)
+            visible += len(self.item_store)
+        # Draw higher layers (the player) on top.
+        on_screen.sort(key=lambda sprite: getattr(sprite, "_layer", 0))
+        self.drawn_sprites = len(on_screen)
+        self.culled_sprites = visible - self.drawn_sprites
+        apply_interpolated = self.camera.apply_interpolated
+        return [(sprite, apply_interpolated(sprite, self.alpha))
+                for sprite in on_screen]
+
+    def draw_overlay(self):
+        # Returns the area of the screen the overlay was drawn on.
+        overlay_rect = pg.Rect(0, 0, 0, 0)
+        bottom = 0
+        if self.show_fps:
+            # Draw FPS
+            text_rect = self.draw_text(
+                f"FPS: {round(self.clock.get_fps(), 2)}", OVERLAY_SIZE,
+                TEXT_COLOR, SCREEN_WIDTH / 2, 0, align="n",
+                font_name=self.theme_font, glyphs=True)
+            # Draw the number of sprites drawn and skipped, and updated and
+            # sleeping.
+            count_rect = self.draw_text(
+                f"Drawn: {self.drawn_sprites} "
+                f"Culled: {self.culled_sprites} "
+                f"Active: {self.scheduler.active_count} "
+                f"Sleeping: {self.scheduler.sleeping_count}",
+                OVERLAY_SIZE // 2, TEXT_COLOR, SCREEN_WIDTH / 2,
+                text_rect.bottom, align="n",
+                font_name=self.theme_font, glyphs=True)
+            bottom = count_rect.bottom
+        if self.profiler.show_overlay:
+            # Draw the profiler percentiles.
+            for line in ["p50 / p95 / p99 (ms)"] + self.profiler.summary():
+                text_rect = self.draw_text(
+                    line, OVERLAY_SIZE // 2, TEXT_COLOR, 10, bottom,
+                    align="nw", font_name=self.theme_font, glyphs=True)
+                bottom = text_rect.bottom
+        if bottom:
+            # The text changes width, so use the whole screen width.
+            overlay_rect = pg.Rect(0, 0, SCREEN_WIDTH, bottom)
+        return overlay_rect
 
     def draw(self):
         # Game draw loop.
+        # Draw in between the last two simulation steps.
+        self.camera.interpolate(self.alpha)
+        sprites = self.sprites_on_screen()
+        # Only redraw what changed if the camera did not move and nothing
+        # else covers the screen.
+        camera_position = (self.camera.x, self.camera.y)
+        if self.dirty_rects and not self.debug and \
+                camera_position == self.drawn_camera and \
+                (self.show_fps or self.profiler.show_overlay) == \
+                bool(self.overlay_rect):
+            self.draw_dirty(sprites)
+        else:
+            self.draw_full(sprites)
+        self.drawn_camera = camera_position
+        # Remember where each sprite was drawn for the next dirty redraw.
+        self.drawn_rects = {
+            sprite: (pg.Rect(position, sprite.image.get_size()), sprite.image)
+            for sprite, position in sprites}
+
+    def draw_dirty(self, sprites):
+        # Redraw only the parts of the screen where sprites moved, appeared or
+        # disappeared.
+        dirty = []
+        drawn_rects = self.drawn_rects
+        sprite_rects = []
+        for sprite, position in sprites:
+            rect = pg.Rect(position, sprite.image.get_size())
+            sprite_rects.append(rect)
+            drawn = drawn_rects.get(sprite)
+            if drawn is None:
+                dirty.append(rect)
+            elif drawn[0] != rect or drawn[1] is not sprite.image:
+                dirty.append(drawn[0])
+                dirty.append(rect)
+        on_screen = {sprite for sprite, position in sprites}
+        for sprite, (rect, image) in drawn_rects.items():
+            if sprite not in on_screen:
+                dirty.append(rect)
+        if self.overlay_rect:
+            dirty.append(self.overlay_rect)
+
+        for rect in dirty:
+            # Draw the background and every sprite that overlaps the rect,
+            # clipped so nothing outside of it is drawn twice.
+            self.screen.set_clip(rect)
+            self.screen.fill(BGCOLOR, rect)
+            self.map.draw(self.screen, self.camera, rect)
+            for index in rect.collidelistall(sprite_rects):
+                sprite, position = sprites[index]
+                self.screen.blit(sprite.image, position)
+        self.screen.set_clip(None)
+
+        self.overlay_rect = self.draw_overlay()
+        pg.display.update(dirty)
+
+    def draw_full(self, sprites):
         self.screen.fill(BGCOLOR)
-        # Map image.
-        self.screen.blit(self.map.image, self.camera.apply_rect(self.map.rect))
-        # Draw all sprites.
-        for sprite in self.visible_sprites:
-            self.screen.blit(sprite.image, self.camera.apply_sprite(sprite))
+        # Map image, only the chunks that are on the screen.
+        self.map.draw(self.screen, self.camera)
+        # Draw the sprites that are on the screen.
+        for sprite, position in sprites:
+            self.screen.blit(sprite.image, position)
 
-        if self.show_fps:
-            # Draw FPS
-            self.draw_text(f"FPS: {round(self.clock.get_fps(), 2)}",
-                           OVERLAY_SIZE,
-                           TEXT_COLOR, SCREEN_WIDTH / 2, 0, align="n",
-                           font_name=self.theme_font)
+        self.overlay_rect = self.draw_overlay()
         if self.debug:
             # Draw debug.
             self.draw_debug()
@@ -261,12 +947,17 @@ class Game:
         # Flip the display (update the display).
         pg.display.flip()
 
-    def draw_text(self, text, size, fillcolor, x, y, align="n", font_name=None):
-        # Create the font.
-        font = pg.font.Font(font_name, size)
-        # Create a surface to put the text on.
-        text_surface = font.render(text, True, fillcolor)
-        text_rect = text_surface.get_rect()
+    def draw_text(self, text, size, fillcolor, x, y, align="n", font_name=None,
+                  glyphs=False):
+        # Use glyphs for text that changes often, so it is drawn from cached
+        # characters instead of being rendered again.
+        if glyphs:
+            text_rect = pg.Rect((0, 0), self.text.glyphs_size(
+                text, fillcolor, font_name, size))
+        else:
+            # Get the (cached) surface with the text on it.
+            text_surface = self.text.render(text, fillcolor, font_name, size)
+            text_rect = text_surface.get_rect()
         # Align the text.
         if align == "nw":
             text_rect.topleft = (x, y)
@@ -286,7 +977,11 @@ class Game:
             text_rect.midleft = (x, y)
         elif align == "center":
             text_rect.center = (x, y)
-        self.screen.blit(text_surface, text_rect)
+        if glyphs:
+            self.text.blit_glyphs(self.screen, text, fillcolor, font_name, size,
+                                  text_rect.topleft)
+        else:
+            self.screen.blit(text_surface, text_rect)
 
         # Return the dimensions of the text rect in case it is needed for
         # positioning multiple text rects so that they fit together nicely.
@@ -294,17 +989,96 @@ class Game:
         return text_rect
 
     def show_start_screen(self):
-        # Game start screen.
-        pass
+        # Game start screen, which shows the loading progress.
+        self.finish_loading(None if self.headless else self.draw_loading)
+
+    def draw_loading(self, done, total):
+        # Loading progress bar.
+        self.screen.fill(BGCOLOR)
+        self.draw_text(TITLE, 80, TEXT_COLOR, SCREEN_WIDTH / 2,
+                       SCREEN_HEIGHT / 3, align="center",
+                       font_name=self.theme_font)
+        bar = pg.Rect(0, 0, SCREEN_WIDTH / 2, 30)
+        bar.center = (SCREEN_WIDTH / 2, SCREEN_HEIGHT / 2)
+        fill = bar.copy()
+        fill.width = bar.width * done / max(total, 1)
+        self.screen.fill(TEXT_COLOR, fill)
+        pg.draw.rect(self.screen, TEXT_COLOR, bar, 2)
+        self.draw_text(f"Loading {done}/{total}", 30, TEXT_COLOR,
+                       SCREEN_WIDTH / 2, bar.bottom + 20, align="n",
+                       font_name=self.theme_font)
+        pg.display.flip()
+        # Keep the window responding while loading.
+        pg.event.pump()
 
     def show_game_over_screen(self):
         # Game over screen.
         pass
 
 
-g = Game()
-g.show_start_screen()
-while g.running:
-    g.new()
+def main():
+    parser = argparse.ArgumentParser(description=TITLE)
+    parser.add_argument("--headless", action="store_true",
+                        help="run the simulation without a display or audio")
+    parser.add_argument("--steps", type=int, default=None,
+                        help="number of simulation steps to run headless")
+    parser.add_argument("--script", default=None,
+                        help="JSON input script to use instead of the "
+                             "keyboard")
+    parser.add_argument("--record", default=None,
+                        help="record the input to a replay file")
+    parser.add_argument("--replay", default=None,
+                        help="replay a recorded input file headless, as "
+                             "fast as possible")
+    parser.add_argument("--profile", default=None,
+                        help="profile every frame and export the results to "
+                             "a CSV or JSON file")
+    args = parser.parse_args()
+
+    input_source = None
+    seed = int(time.time())
+    if args.replay:
+        input_source = InputReplayer.load(args.replay)
+        seed = input_source.seed
+        args.headless = True
+    elif args.script:
+        input_source = ScriptedInput.from_file(args.script,
+                                               loop=args.steps is not None)
+    elif args.headless:
+        # No keys pressed.
+        input_source = ScriptedInput(lambda frame: ((), ()))
+    if args.record:
+        if input_source is None:
+            input_source = KeyboardInput()
+        input_source = InputRecorder(input_source, 1 / SIM_RATE, seed)
+    # Recordings replay with the same random numbers.
+    random.seed(seed)
+
+    g = Game(args.headless, input_source, args.steps)
+    if args.replay:
+        g.dt = input_source.dt
+    if args.profile:
+        g.profiler.enabled = True
+    g.show_start_screen()
+    while g.running:
+        g.new()
+
+    if args.headless:
+        print(f"{g.steps} steps ({g.steps * g.dt:.1f} simulated seconds)"
+              f" in {g.elapsed:.2f} s, {g.steps_per_second:.0f} steps/s")
+    if args.profile:
+        g.profiler.export(args.profile)
+        print("\n".join(g.profiler.summary()))
+    if args.record:
+        input_source.save(args.record)
+    if args.replay:
+        if input_source.matches():
+            print("Replay matches the recording.")
+        else:
+            print("Replay does not match the recording.")
+
+    pg.quit()
+
 
-pg.quit()
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,371 @@
+import os
+import sys
+import json
+import struct
+import hashlib
+from xml.etree import ElementTree
+from array import array
+import pygame as pg
+import pytmx
+from settings import *
+
+# Binary map cache layout (all integers are little endian):
+#   header: magic, version, fingerprint length, fingerprint
+#   map size: width, height, tile width, tile height
+#   tile layers: count, then for each layer the name, visible flag and
+#                width * height uint32 tile GIDs
+#   tile images: count, then for each GID the width, height and RGBA pixels
+#                (0x0 for a GID without an image)
+#   objects and tile properties: a JSON document
+CACHE_MAGIC = b"BLKMAP"
+CACHE_VERSION = 1
+HEADER = struct.Struct("<6sHI")
+MAP_SIZE = struct.Struct("<IIII")
+COUNT = struct.Struct("<I")
+LAYER = struct.Struct("<IB")
+IMAGE_SIZE = struct.Struct("<HH")
+
+
+def plain_value(value):
+    # A property value made of JSON types, so it can be cached. Tile
+    # collision shapes become [x, y, width, height] lists and animation
+    # frames [gid, duration] lists.
+    if isinstance(value, pytmx.TiledObjectGroup):
+        return [[obj.x, obj.y, obj.width, obj.height] for obj in value]
+    if isinstance(value, (list, tuple)):
+        return [plain_value(item) for item in value]
+    if isinstance(value, dict):
+        return {str(key): plain_value(item) for key, item in value.items()}
+    if value is None or isinstance(value, (str, int, float, bool)):
+        return value
+    return str(value)
+
+
+def plain_properties(properties):
+    return {key: plain_value(value) for key, value in properties.items()}
+
+
+class MapObject:
+    # A map object with the same attributes the game uses from pytmx
+    # objects. Custom properties can also be read as attributes, like
+    # tile_object.object.
+    def __init__(self, id, name, type, x, y, width, height, properties):
+        self.id = id
+        self.name = name
+        self.type = type
+        self.x = x
+        self.y = y
+        self.width = width
+        self.height = height
+        self.properties = properties
+        for key, value in properties.items():
+            if not hasattr(self, key):
+                setattr(self, key, value)
+
+    def to_record(self):
+        return [self.id, self.name, self.type, self.x, self.y, self.width,
+                self.height, self.properties]
+
+
+class TileLayer:
+    def __init__(self, name, visible, width, height, data):
+        self.name = name
+        self.visible = visible
+        self.width = width
+        self.height = height
+        # Tile GIDs, row by row.
+        self.data = data
+
+    def __iter__(self):
+        # Same as iterating a pytmx tile layer, (x, y, gid) for every tile.
+        width = self.width
+        for index, gid in enumerate(self.data):
+            yield index % width, index // width, gid
+
+
+class MapData:
+    # Everything the game needs from a map file.
+    def __init__(self, width, height, tilewidth, tileheight, layers, images,
+                 objects, tile_properties, sources=None):
+        self.width = width
+        self.height = height
+        self.tilewidth = tilewidth
+        self.tileheight = tileheight
+        self.layers = layers
+        # Tile images by GID (None where there is no image).
+        self.images = images
+        self.objects = objects
+        self.tile_properties = tile_properties
+        # The files the map was made from (see source_files), if they are
+        # known.
+        self.sources = sources
+
+    @classmethod
+    def from_tmx(cls, filename):
+        tilemap_data = pytmx.load_pygame(filename, pixelalpha=True)
+        width, height = tilemap_data.width, tilemap_data.height
+        layers = []
+        for layer in tilemap_data.layers:
+            if isinstance(layer, pytmx.TiledTileLayer):
+                data = array("I")
+                for row in layer.data:
+                    data.extend(row)
+                layers.append(TileLayer(layer.name, bool(layer.visible),
+                                        width, height, data))
+        objects = [MapObject(obj.id, obj.name, obj.type, obj.x, obj.y,
+                             obj.width, obj.height,
+                             plain_properties(obj.properties))
+                   for obj in tilemap_data.objects]
+        tile_properties = {}
+        for gid in range(len(tilemap_data.images)):
+            properties = tilemap_data.get_tile_properties_by_gid(gid)
+            if properties:
+                tile_properties[gid] = plain_properties(properties)
+        return cls(width, height, tilemap_data.tilewidth,
+                   tilemap_data.tileheight, layers, list(tilemap_data.images),
+                   objects, tile_properties, source_files(filename))
+
+
+def cache_filename(filename):
+    return os.path.splitext(filename)[0] + MAP_CACHE_EXTENSION
+
+
+def source_files(filename):
+    # The map file and the tileset files and images it uses. If any of them
+    # change, the cache is stale. The tilesets come before the layers in a
+    # map file, so only the start of the file is read.
+    files = [filename]
+    folder = os.path.dirname(filename)
+    in_tileset = False
+    for event, element in ElementTree.iterparse(filename, ("start", "end")):
+        if element.tag == "tileset":
+            in_tileset = event == "start"
+            if not in_tileset:
+                files.extend(tileset_files(folder, element))
+        elif event == "start" and not in_tileset and \
+                element.tag in ("layer", "objectgroup", "imagelayer",
+                                "group"):
+            break
+    return files
+
+
+def tileset_files(folder, tileset):
+    # The files of a tileset element: its TSX file if it is in one, and its
+    # images.
+    files = []
+    source = tileset.get("source")
+    if source:
+        path = os.path.join(folder, source)
+        files.append(path)
+        tileset = ElementTree.parse(path).getroot()
+        folder = os.path.dirname(path)
+    for image in tileset.iter("image"):
+        if image.get("source"):
+            files.append(os.path.join(folder, image.get("source")))
+    return files
+
+
+def fingerprint(files):
+    # The stats let a cache be checked without reading the sources. The hash
+    # catches files that were touched or copied without being changed.
+    sha1 = hashlib.sha1()
+    stats = []
+    for path in files:
+        stat = os.stat(path)
+        stats.append([os.path.relpath(path, os.path.dirname(files[0])),
+                      stat.st_size, stat.st_mtime_ns])
+        with open(path, "rb") as file:
+            sha1.update(file.read())
+    return {"files": stats, "sha1": sha1.hexdigest()}
+
+
+def stats_match(cached, files):
+    # True if the sources have the sizes and modification times in the
+    # fingerprint of a cache, which is checked without reading them.
+    try:
+        stats = cached["files"]
+        if len(stats) != len(files):
+            return False
+        for path, (relpath, size, mtime) in zip(files, stats):
+            stat = os.stat(path)
+            if stat.st_size != size or stat.st_mtime_ns != mtime:
+                return False
+        return True
+    except (OSError, KeyError, TypeError, ValueError):
+        return False
+
+
+def encode_map(map_data):
+    # The map data in the cache layout, after the header.
+    chunks = []
+    chunks.append(MAP_SIZE.pack(map_data.width, map_data.height,
+                                map_data.tilewidth, map_data.tileheight))
+
+    chunks.append(COUNT.pack(len(map_data.layers)))
+    for layer in map_data.layers:
+        name = layer.name.encode()
+        chunks.append(LAYER.pack(len(name), layer.visible))
+        chunks.append(name)
+        data = array("I", layer.data)
+        if sys.byteorder != "little":
+            data.byteswap()
+        chunks.append(data.tobytes())
+
+    chunks.append(COUNT.pack(len(map_data.images)))
+    for image in map_data.images:
+        if image is None:
+            chunks.append(IMAGE_SIZE.pack(0, 0))
+        else:
+            chunks.append(IMAGE_SIZE.pack(*image.get_size()))
+            chunks.append(pg.image.tobytes(image, "RGBA"))
+
+    extra = json.dumps({
+        "objects": [obj.to_record() for obj in map_data.objects],
+        "tile_properties": map_data.tile_properties
+    }).encode()
+    chunks.append(COUNT.pack(len(extra)))
+    chunks.append(extra)
+    return b"".join(chunks)
+
+
+def write_cache(filename, map_data, files=None):
+    if files is None:
+        files = map_data.sources or source_files(filename)
+    return write_cache_data(filename, fingerprint(files), encode_map(map_data))
+
+
+def write_cache_data(filename, info, data):
+    info = json.dumps(info).encode()
+    # Write to a temporary file first so a half written cache is never read.
+    path = cache_filename(filename)
+    temp_path = path + ".tmp"
+    with open(temp_path, "wb") as file:
+        file.write(HEADER.pack(CACHE_MAGIC, CACHE_VERSION, len(info)))
+        file.write(info)
+        file.write(data)
+    os.replace(temp_path, path)
+    return path
+
+
+def read_cache(filename, check=True):
+    # Load the cached map data, or return None if there is no usable cache.
+    path = cache_filename(filename)
+    try:
+        with open(path, "rb") as file:
+            buffer = file.read()
+    except OSError:
+        return None
+    view = memoryview(buffer)
+    try:
+        magic, version, info_length = HEADER.unpack_from(view, 0)
+        if magic != CACHE_MAGIC or version != CACHE_VERSION:
+            return None
+        offset = HEADER.size
+        info = json.loads(bytes(view[offset:offset + info_length]))
+        offset += info_length
+        if check:
+            folder = os.path.dirname(filename)
+            files = [os.path.join(folder, relpath)
+                     for relpath, size, mtime in info["files"]]
+            if os.path.normpath(files[0]) != os.path.normpath(filename):
+                return None
+            if not stats_match(info, files):
+                # Something was touched, so compare the contents.
+                current = fingerprint(files)
+                if current["sha1"] != info["sha1"]:
+                    return None
+                # Not changed (a checkout or a copy). Stamp the cache with
+                # the new stats so the next load does not hash the sources
+                # again.
+                try:
+                    write_cache_data(filename, current, view[offset:])
+                except OSError:
+                    pass
+        map_data = decode_map(view, offset)
+        if check:
+            map_data.sources = files
+        return map_data
+    except (OSError, struct.error, KeyError, TypeError, ValueError):
+        # A short or corrupt cache, or sources that can not be read.
+        return None
+
+
+def decode_map(view, offset=0):
+    # Map data from the cache layout (after the header) in a buffer. The
+    # tile images are copied out, so the buffer can be freed after loading.
+    width, height, tilewidth, tileheight = MAP_SIZE.unpack_from(view, offset)
+    offset += MAP_SIZE.size
+
+    layers = []
+    (count,) = COUNT.unpack_from(view, offset)
+    offset += COUNT.size
+    for _ in range(count):
+        name_length, visible = LAYER.unpack_from(view, offset)
+        offset += LAYER.size
+        name = bytes(view[offset:offset + name_length]).decode()
+        offset += name_length
+        data = array("I")
+        data.frombytes(view[offset:offset + width * height * data.itemsize])
+        if sys.byteorder != "little":
+            data.byteswap()
+        offset += width * height * data.itemsize
+        layers.append(TileLayer(name, bool(visible), width, height, data))
+
+    images = []
+    # Match pytmx, which converts the tiles when there is a display.
+    convert = pg.display.get_surface() is not None
+    (count,) = COUNT.unpack_from(view, offset)
+    offset += COUNT.size
+    for _ in range(count):
+        image_width, image_height = IMAGE_SIZE.unpack_from(view, offset)
+        offset += IMAGE_SIZE.size
+        if not image_width:
+            images.append(None)
+            continue
+        size = image_width * image_height * 4
+        image = pg.image.frombuffer(view[offset:offset + size],
+                                    (image_width, image_height), "RGBA")
+        offset += size
+        image = image.convert_alpha() if convert else image.copy()
+        images.append(image)
+
+    (extra_length,) = COUNT.unpack_from(view, offset)
+    offset += COUNT.size
+    extra = json.loads(bytes(view[offset:offset + extra_length]))
+    objects = [MapObject(*record) for record in extra["objects"]]
+    tile_properties = {int(gid): properties for gid, properties in
+                       extra["tile_properties"].items()}
+    return MapData(width, height, tilewidth, tileheight, layers, images,
+                   objects, tile_properties)
+
+
+def load_map_data(filename, use_cache=True):
+    # Load from the cache when it is fresh, otherwise parse the TMX file and
+    # compile a new cache for next time.
+    if use_cache:
+        map_data = read_cache(filename)
+        if map_data is not None:
+            return map_data
+    map_data = MapData.from_tmx(filename)
+    if use_cache:
+        try:
+            write_cache(filename, map_data)
+        except (OSError, TypeError, ValueError):
+            # The map folder may be read only, or the map may have
+            # something the cache can not store. The map still loaded fine.
+            pass
+    return map_data
+
+
+def compile_map(filename):
+    return write_cache(filename, MapData.from_tmx(filename))
+
+
+if __name__ == "__main__":
+    # Compile the map caches ahead of time:
+    #   python mapcache.py map/map1.tmx ...
+    os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+    pg.init()
+    pg.display.set_mode((1, 1))
+    for tmx_filename in sys.argv[1:]:
+        print(compile_map(tmx_filename))
@@ -0,0 +1,73 @@
+import numpy as np
+import pygame as pg
+from settings import *
+
+
+class SolidTile:
+    # A solid tile that was hit, with a hit rect like the wall sprites.
+    def __init__(self, rect):
+        self.rect = rect
+        self.hit_rect = rect
+
+
+class OccupancyGrid:
+    # One cell per tile, 1 where the tile is solid. Collision with the tiles
+    # is a direct lookup of the cells under a rect, no matter how many solid
+    # tiles the map has.
+    def __init__(self, solid, tilewidth, tileheight):
+        self.solid = solid
+        self.rows, self.columns = solid.shape
+        self.tilewidth = tilewidth
+        self.tileheight = tileheight
+        # Hit objects for the tiles that have been hit, so they are only
+        # created once.
+        self.tiles = {}
+
+    @classmethod
+    def from_map(cls, tiled_map, layer_name=COLLISION_LAYER,
+                 solid_property=SOLID_TILE_PROPERTY):
+        # Tiles are solid if they are in the collision layer, or if their
+        # tile has the solid property (in any layer).
+        shape = (tiled_map.rows, tiled_map.columns)
+        solid = np.zeros(shape, np.uint8)
+        solid_gids = [gid for gid, properties in
+                      tiled_map.tile_properties.items()
+                      if properties.get(solid_property)]
+        for layer in tiled_map.layers:
+            gids = np.frombuffer(layer.data, np.uint32).reshape(shape)
+            if layer.name == layer_name:
+                solid |= gids != 0
+            elif solid_gids:
+                solid |= np.isin(gids, solid_gids)
+        return cls(solid, tiled_map.tilewidth, tiled_map.tileheight)
+
+    def __len__(self):
+        return int(np.count_nonzero(self.solid))
+
+    def cell_range(self, rect):
+        left = max(0, rect.left // self.tilewidth)
+        top = max(0, rect.top // self.tileheight)
+        right = min(self.columns, (rect.right - 1) // self.tilewidth + 1)
+        bottom = min(self.rows, (rect.bottom - 1) // self.tileheight + 1)
+        return left, top, right, bottom
+
+    def collide(self, rect):
+        # The solid tiles under a rect.
+        left, top, right, bottom = self.cell_range(rect)
+        if left >= right or top >= bottom:
+            return []
+        cells = self.solid[top:bottom, left:right]
+        if not cells.any():
+            return []
+        hits = []
+        for row, column in zip(*np.nonzero(cells)):
+            hits.append(self.tile(left + int(column), top + int(row)))
+        return hits
+
+    def tile(self, column, row):
+        tile = self.tiles.get((column, row))
+        if tile is None:
+            tile = self.tiles[(column, row)] = SolidTile(pg.Rect(
+                column * self.tilewidth, row * self.tileheight,
+                self.tilewidth, self.tileheight))
+        return tile
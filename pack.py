@@ -0,0 +1,201 @@
+import io
+import os
+import sys
+import json
+import mmap
+import struct
+import pygame as pg
+from settings import *
+from mapcache import MapData, encode_map, decode_map
+
+# Asset pack layout (all integers are little endian):
+#   header: magic, version, index length
+#   index: a JSON document with an entry for each file, by its path relative
+#          to the game folder ("img/bridge.png")
+#   data: starts at the first multiple of ALIGNMENT bytes after the index,
+#         with the data of each entry at the offset in its entry (from the
+#         start of the data, also aligned)
+# Entries are stored already decoded where that is possible, so loading them
+# is a lookup into the pack:
+#   "image": RGBA pixels, with the width and height
+#   "sound": the WAV file, with where its samples are and their format
+#   "map": compiled map data in the map cache layout (see mapcache.py)
+#   "raw": the file as it is (fonts and music)
+PACK_MAGIC = b"BLKPACK"
+PACK_VERSION = 1
+HEADER = struct.Struct("<7sHI")
+ALIGNMENT = 16
+IMAGE_EXTENSIONS = (".png", ".jpg", ".jpeg", ".bmp", ".gif")
+WAV_CHUNK = struct.Struct("<4sI")
+WAV_FORMAT = struct.Struct("<HHIIHH")
+# Sample sizes in WAV files, to the matching pygame mixer formats.
+MIXER_FORMATS = {8: 8, 16: -16}
+
+
+def wav_samples(data):
+    # Offset and size of the samples in a PCM WAV file, and their frequency,
+    # mixer format and channels. None if it is not a plain PCM WAV file.
+    if data[:4] != b"RIFF" or data[8:12] != b"WAVE":
+        return None
+    offset = 12
+    sample_format = None
+    while offset + WAV_CHUNK.size <= len(data):
+        chunk_id, size = WAV_CHUNK.unpack_from(data, offset)
+        offset += WAV_CHUNK.size
+        if chunk_id == b"fmt ":
+            audio_format, channels, frequency, _, _, bits = \
+                WAV_FORMAT.unpack_from(data, offset)
+            if audio_format != 1 or bits not in MIXER_FORMATS:
+                return None
+            sample_format = [frequency, MIXER_FORMATS[bits], channels]
+        elif chunk_id == b"data" and sample_format:
+            return [offset, min(size, len(data) - offset), sample_format]
+        # Chunks are padded to an even size.
+        offset += size + size % 2
+    return None
+
+
+class AssetPack:
+    # The game assets in one file, which is memory mapped so the files do not
+    # have to be opened and read one by one. Assets are looked up by the same
+    # paths as the loose files. Images are made from the pixels in the
+    # mapped file without copying them, so the pack has to stay open while
+    # they are used (the game converts them, which copies them).
+    def __init__(self, filename, folder=None):
+        # The folder the paths in the pack are relative to, the folder the
+        # pack is in by default.
+        if folder is None:
+            folder = os.path.dirname(os.path.abspath(filename))
+        self.folder = folder
+        with open(filename, "rb") as file:
+            self.data = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        # Read the whole pack in ahead of time, instead of a page at a time
+        # as assets are loaded.
+        if hasattr(self.data, "madvise") and hasattr(mmap, "MADV_WILLNEED"):
+            self.data.madvise(mmap.MADV_WILLNEED)
+        self.view = memoryview(self.data)
+        magic, version, index_length = HEADER.unpack_from(self.view, 0)
+        if magic != PACK_MAGIC or version != PACK_VERSION:
+            raise ValueError(f"{filename} is not a version {PACK_VERSION} "
+                             f"asset pack")
+        self.entries = json.loads(bytes(
+            self.view[HEADER.size:HEADER.size + index_length]))
+        header_size = HEADER.size + index_length
+        self.data_start = header_size + -header_size % ALIGNMENT
+
+    def key(self, path):
+        return os.path.relpath(os.path.abspath(path),
+                               self.folder).replace(os.sep, "/")
+
+    def __contains__(self, path):
+        return self.key(path) in self.entries
+
+    def entry(self, path):
+        entry = self.entries[self.key(path)]
+        offset = self.data_start + entry["offset"]
+        return entry, self.view[offset:offset + entry["size"]]
+
+    def open(self, path):
+        # A file object with the file data (for fonts and music).
+        entry, data = self.entry(path)
+        return io.BytesIO(data)
+
+    def image(self, path):
+        entry, data = self.entry(path)
+        if entry["kind"] != "image":
+            return pg.image.load(io.BytesIO(data), path)
+        return pg.image.frombuffer(data, (entry["width"], entry["height"]),
+                                   "RGBA")
+
+    def sound(self, path):
+        # Sounds are made straight from their samples if the mixer uses the
+        # same format, otherwise the WAV file is decoded.
+        entry, data = self.entry(path)
+        samples = entry.get("samples")
+        mixer = pg.mixer.get_init()
+        if samples is not None and mixer and list(mixer) == samples[2]:
+            offset, size = samples[0], samples[1]
+            return pg.mixer.Sound(buffer=data[offset:offset + size])
+        return pg.mixer.Sound(file=io.BytesIO(data))
+
+    def map_data(self, path):
+        entry, data = self.entry(path)
+        return decode_map(data)
+
+
+def open_pack(filename):
+    # The asset pack, or None if there is no usable pack.
+    try:
+        return AssetPack(filename)
+    except (OSError, ValueError, struct.error):
+        return None
+
+
+def pack_entry(path):
+    # The entry (without its offset and size) and the data to pack for a
+    # file, or None for files that are not packed.
+    extension = os.path.splitext(path)[1].lower()
+    if extension in IMAGE_EXTENSIONS:
+        image = pg.image.load(path)
+        entry = {"kind": "image", "width": image.get_width(),
+                 "height": image.get_height()}
+        return entry, pg.image.tobytes(image, "RGBA")
+    if extension == ".tmx":
+        return {"kind": "map"}, encode_map(MapData.from_tmx(path))
+    if extension == MAP_CACHE_EXTENSION:
+        return None
+    with open(path, "rb") as file:
+        data = file.read()
+    if extension == ".wav":
+        return {"kind": "sound", "samples": wav_samples(data)}, data
+    return {"kind": "raw"}, data
+
+
+def write_pack(filename, folders, game_folder):
+    # Pack every file in the folders (relative to the game folder).
+    entries = {}
+    chunks = []
+    offset = 0
+    for folder in folders:
+        for root, dirs, files in os.walk(os.path.join(game_folder, folder)):
+            dirs.sort()
+            for name in sorted(files):
+                path = os.path.join(root, name)
+                packed = pack_entry(path)
+                if packed is None:
+                    continue
+                entry, data = packed
+                padding = -offset % ALIGNMENT
+                chunks.append(bytes(padding))
+                offset += padding
+                entry["offset"] = offset
+                entry["size"] = len(data)
+                chunks.append(data)
+                offset += len(data)
+                key = os.path.relpath(path, game_folder).replace(os.sep, "/")
+                entries[key] = entry
+
+    index = json.dumps(entries).encode()
+    header_size = HEADER.size + len(index)
+    temp_path = filename + ".tmp"
+    with open(temp_path, "wb") as file:
+        file.write(HEADER.pack(PACK_MAGIC, PACK_VERSION, len(index)))
+        file.write(index)
+        file.write(bytes(-header_size % ALIGNMENT))
+        file.write(b"".join(chunks))
+    os.replace(temp_path, filename)
+    return filename
+
+
+if __name__ == "__main__":
+    # Pack the assets into one file next to the game, which it loads from
+    # instead of the loose files while it exists:
+    #   python pack.py [pack file]
+    # Pack again after changing any of the assets.
+    os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+    pg.init()
+    pg.display.set_mode((1, 1))
+    game_folder = os.path.dirname(os.path.abspath(__file__))
+    pack_filename = sys.argv[1] if len(sys.argv) > 1 else \
+        os.path.join(game_folder, ASSET_PACK)
+    print(write_pack(pack_filename, PACK_FOLDERS, game_folder))
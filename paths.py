@@ -0,0 +1,71 @@
+from bisect import bisect_right
+from pygame.math import Vector2 as Vec
+
+
+class CompiledPath:
+    # A moving obstacle movement spec turned into a table of straight
+    # segments, so the position at any time can be found directly instead of
+    # adding up velocity every step (which slowly drifts). Positions are
+    # relative to where the path starts, so every obstacle with the same
+    # movement can share one path.
+    def __init__(self, movement):
+        parts = [movement["parts"][part] for part in movement["parts"]]
+        segments = [(Vec(part["vel"], 0).rotate(-part["rot"]),
+                     part["distance"] / part["vel"]) for part in parts]
+        if movement["back"]:
+            # Go back along the same parts in reverse.
+            segments += [(-vel, duration) for vel, duration in
+                         reversed(segments)]
+
+        self.start_times = []
+        self.offsets = []
+        self.velocities = []
+        # The fastest the path moves, to know how far it can go in a step.
+        self.max_speed = max(vel.length() for vel, duration in segments)
+        time = 0
+        offset = Vec(0, 0)
+        for vel, duration in segments:
+            self.start_times.append(time)
+            self.offsets.append((offset.x, offset.y))
+            self.velocities.append((vel.x, vel.y))
+            time += duration
+            offset += vel * duration
+        # One loop through all of the segments.
+        self.period = time
+        # Where a loop ends. Without going back, the next loop starts from
+        # there.
+        self.loop_offset = (offset.x, offset.y)
+        if movement["back"]:
+            self.loop_offset = (0.0, 0.0)
+        # The area the path covers, relative to the start, as (left, top,
+        # right, bottom). Paths that do not go back keep moving away, so
+        # they have no bounds.
+        self.bounds = None
+        if self.loop_offset == (0.0, 0.0):
+            xs = [x for x, y in self.offsets]
+            ys = [y for x, y in self.offsets]
+            self.bounds = (min(xs), min(ys), max(xs), max(ys))
+
+    def segment_at(self, time):
+        # Number of full loops, the segment and the time into the segment.
+        loops, time = divmod(time, self.period)
+        segment = bisect_right(self.start_times, time) - 1
+        return loops, segment, time - self.start_times[segment]
+
+    def evaluate(self, time):
+        # Position (relative to the start) and velocity at a time.
+        loops, segment, time = self.segment_at(time)
+        offset_x, offset_y = self.offsets[segment]
+        vel_x, vel_y = self.velocities[segment]
+        return (loops * self.loop_offset[0] + offset_x + vel_x * time,
+                loops * self.loop_offset[1] + offset_y + vel_y * time,
+                vel_x, vel_y)
+
+
+def compile_movement(movement, cache={}):
+    # Obstacles with the same movement spec share the same compiled path.
+    key = repr(movement)
+    path = cache.get(key)
+    if path is None:
+        path = cache[key] = CompiledPath(movement)
+    return path
@@ -0,0 +1,126 @@
+import csv
+import json
+import time
+from collections import deque
+from settings import *
+
+
+class Profiler:
+    # Times parts of each frame (events, update, draw, the update of each
+    # sprite class) and counts things like collision queries. The last
+    # PROFILER_WINDOW frames are kept for rolling percentiles, and the last
+    # PROFILER_HISTORY frames for exporting. Timing only happens while the
+    # profiler is enabled, so it costs almost nothing when it is off.
+    def __init__(self, window=PROFILER_WINDOW, history=PROFILER_HISTORY):
+        self.enabled = False
+        self.show_overlay = False
+        self.window = window
+        # Section name to the time (ms) it took in the last frames.
+        self.samples = {}
+        # Whole frames, as dicts of section times (ms) and counts.
+        self.history = deque(maxlen=history)
+        self.frame_number = 0
+        # Data for the frame that is running.
+        self.frame_times = {}
+        self.frame_counts = {}
+        self.started = {}
+        self.frame_start = None
+
+    def toggle(self):
+        # Show the overlay, which also turns on the profiler.
+        self.show_overlay = not self.show_overlay
+        self.enabled = self.show_overlay
+        self.frame_start = None
+
+    def start(self, name):
+        if self.enabled:
+            self.started[name] = time.perf_counter()
+
+    def stop(self, name):
+        # The profiler may have been turned on after the section started.
+        start = self.started.pop(name, None)
+        if self.enabled and start is not None:
+            self.add_time(name, time.perf_counter() - start)
+
+    def add_time(self, name, seconds):
+        self.frame_times[name] = self.frame_times.get(name, 0) + seconds
+
+    def count(self, name, amount=1):
+        if self.enabled:
+            self.frame_counts[name] = self.frame_counts.get(name, 0) + amount
+
+    def update_sprites(self, sprites):
+        # Updates the sprites, timed for each sprite class.
+        perf_counter = time.perf_counter
+        frame_times = self.frame_times
+        for sprite in sprites:
+            start = perf_counter()
+            sprite.update()
+            name = "update " + type(sprite).__name__
+            frame_times[name] = frame_times.get(name, 0) + \
+                perf_counter() - start
+
+    def end_frame(self):
+        if not self.enabled:
+            return
+        now = time.perf_counter()
+        if self.frame_start is not None:
+            self.add_time("total", now - self.frame_start)
+        self.frame_start = now
+
+        row = {"frame": self.frame_number}
+        for name, seconds in self.frame_times.items():
+            milliseconds = seconds * 1000
+            row[name] = milliseconds
+            if name not in self.samples:
+                self.samples[name] = deque(maxlen=self.window)
+            self.samples[name].append(milliseconds)
+        for name, amount in self.frame_counts.items():
+            row[name] = amount
+            if name not in self.samples:
+                self.samples[name] = deque(maxlen=self.window)
+            self.samples[name].append(amount)
+        self.history.append(row)
+        self.frame_number += 1
+        self.frame_times = {}
+        self.frame_counts = {}
+
+    def percentiles(self, name, percents=(50, 95, 99)):
+        values = sorted(self.samples.get(name, ()))
+        if not values:
+            return [0 for _ in percents]
+        last = len(values) - 1
+        return [values[round(last * percent / 100)] for percent in percents]
+
+    def summary(self):
+        # Lines of text for the overlay, the 50th, 95th and 99th percentiles
+        # of every section and count.
+        lines = []
+        for name in sorted(self.samples):
+            p50, p95, p99 = self.percentiles(name)
+            lines.append(f"{name}: {p50:.2f} / {p95:.2f} / {p99:.2f}")
+        return lines
+
+    def export(self, filename):
+        # Save the frame history as CSV or JSON, based on the file extension.
+        rows = list(self.history)
+        if filename.endswith(".json"):
+            data = {
+                "frames": rows,
+                "percentiles": {name: dict(zip(("p50", "p95", "p99"),
+                                               self.percentiles(name)))
+                                for name in self.samples}
+            }
+            with open(filename, "w") as file:
+                json.dump(data, file, indent=1)
+        else:
+            columns = ["frame"]
+            for row in rows:
+                for name in row:
+                    if name not in columns:
+                        columns.append(name)
+            with open(filename, "w", newline="") as file:
+                writer = csv.DictWriter(file, columns, restval=0)
+                writer.writeheader()
+                writer.writerows(rows)
+        return filename
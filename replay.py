@@ -0,0 +1,188 @@
+import struct
+import hashlib
+import pygame as pg
+from pygame.locals import *
+from inputs import InputSource, KeyState
+
+# Replay file layout (all little endian):
+#   header: magic, version, simulation step (dt), random seed
+#   frames: run length encoded records of (repeat, steps, held, pressed)
+#   footer: magic, frame count, step count, player position digest, final
+#           player position
+REPLAY_MAGIC = b"BLKREC"
+REPLAY_VERSION = 1
+HEADER = struct.Struct("<6sHdQ")
+FRAME = struct.Struct("<HBBB")
+FOOTER = struct.Struct("<3sII20sdd")
+POSITION = struct.Struct("<dd")
+MAX_REPEAT = 0xFFFF
+
+# Keys that are held down (read by Player.apply_keys), and keys that are
+# pushed (KEYDOWN events handled by Game.events) that change the
+# simulation. Each key is one bit in the frame record.
+HELD_KEYS = [K_a, K_LEFT, K_d, K_RIGHT, K_SPACE]
+PRESSED_KEYS = [K_SPACE, K_g, K_c, K_ESCAPE, K_m, K_k, K_t]
+
+
+class PositionDigest:
+    # Hash of the player position after every simulation step, to check that
+    # a replay follows exactly the same path as the recording.
+    def __init__(self):
+        self.sha1 = hashlib.sha1()
+        self.position = (0.0, 0.0)
+
+    def add(self, position):
+        self.position = (position.x, position.y)
+        self.sha1.update(POSITION.pack(*self.position))
+
+    def digest(self):
+        return self.sha1.digest()
+
+    def copy(self):
+        positions = PositionDigest()
+        positions.sha1 = self.sha1.copy()
+        positions.position = self.position
+        return positions
+
+
+class InputRecorder(InputSource):
+    # Records the input read from another input source. Only the keys that
+    # change the simulation are kept, and the game reads them back from the
+    # recorder so it sees exactly what is recorded.
+    def __init__(self, source, dt, seed=0):
+        self.source = source
+        self.dt = dt
+        self.seed = seed
+        self.held = KeyState()
+        self.held_bits = 0
+        self.pressed_bits = 0
+        # (repeat, steps, held, pressed)
+        self.records = []
+        self.frames = 0
+        self.steps = 0
+        self.positions = PositionDigest()
+
+    @property
+    def finished(self):
+        return self.source.finished
+
+    @property
+    def frame_steps(self):
+        return self.source.frame_steps
+
+    def next_frame(self):
+        self.source.next_frame()
+
+    def get_events(self):
+        events = self.source.get_events()
+        keys = self.source.get_pressed()
+        self.held_bits = 0
+        for bit, key in enumerate(HELD_KEYS):
+            if keys[key]:
+                self.held_bits |= 1 << bit
+        self.held = KeyState(key for key in HELD_KEYS if keys[key])
+        self.pressed_bits = 0
+        for event in events:
+            if event.type == QUIT:
+                self.pressed_bits |= 1 << PRESSED_KEYS.index(K_ESCAPE)
+            elif event.type == KEYDOWN and event.key in PRESSED_KEYS:
+                self.pressed_bits |= 1 << PRESSED_KEYS.index(event.key)
+        return events
+
+    def get_pressed(self):
+        return self.held
+
+    def end_step(self, game):
+        self.positions.add(game.player.pos)
+
+    def end_frame(self, steps):
+        self.frames += 1
+        self.steps += steps
+        record = [steps, self.held_bits, self.pressed_bits]
+        if self.records and self.records[-1][1:] == record and \
+                self.records[-1][0] < MAX_REPEAT:
+            self.records[-1][0] += 1
+        else:
+            self.records.append([1, *record])
+
+    def to_bytes(self):
+        chunks = [HEADER.pack(REPLAY_MAGIC, REPLAY_VERSION, self.dt,
+                              self.seed)]
+        chunks.extend(FRAME.pack(*record) for record in self.records)
+        chunks.append(FOOTER.pack(b"END", self.frames, self.steps,
+                                  self.positions.digest(),
+                                  *self.positions.position))
+        return b"".join(chunks)
+
+    def save(self, filename):
+        with open(filename, "wb") as file:
+            file.write(self.to_bytes())
+
+
+class InputReplayer(InputSource):
+    # Plays back a recording as input, with the same number of simulation
+    # steps in each frame as when it was recorded.
+    def __init__(self, data):
+        magic, version, self.dt, self.seed = HEADER.unpack_from(data, 0)
+        if magic != REPLAY_MAGIC or version != REPLAY_VERSION:
+            raise ValueError("Not a replay file.")
+        footer_offset = len(data) - FOOTER.size
+        (end, self.recorded_frames, self.recorded_steps, self.recorded_digest,
+         *self.recorded_position) = FOOTER.unpack_from(data, footer_offset)
+        if end != b"END":
+            raise ValueError("Replay file is incomplete.")
+        self.records = [FRAME.unpack_from(data, offset) for offset in
+                        range(HEADER.size, footer_offset, FRAME.size)]
+        self.record = -1
+        self.repeat = 0
+        self.finished = False
+        self.frame_steps = 0
+        self.held = KeyState()
+        self.pressed = []
+        self.positions = PositionDigest()
+
+    @classmethod
+    def load(cls, filename):
+        with open(filename, "rb") as file:
+            return cls(file.read())
+
+    def next_frame(self):
+        if self.repeat == 0:
+            self.record += 1
+            if self.record >= len(self.records):
+                self.finished = True
+                self.frame_steps = 0
+                self.held, self.pressed = KeyState(), []
+                return
+            self.repeat, self.frame_steps, held_bits, pressed_bits = \
+                self.records[self.record]
+            self.held = KeyState(key for bit, key in enumerate(HELD_KEYS)
+                                 if held_bits & 1 << bit)
+            self.pressed = [key for bit, key in enumerate(PRESSED_KEYS)
+                            if pressed_bits & 1 << bit]
+        self.repeat -= 1
+
+    def get_events(self):
+        return [pg.event.Event(KEYDOWN, key=key) for key in self.pressed]
+
+    def get_pressed(self):
+        return self.held
+
+    def end_step(self, game):
+        self.positions.add(game.player.pos)
+
+    def snapshot(self):
+        # Where the replay is. Restoring it along with a game snapshot from
+        # the same frame seeks the replay back to that frame.
+        return (self.record, self.repeat, self.finished, self.frame_steps,
+                self.held, self.pressed, self.positions.copy())
+
+    def restore(self, state):
+        (self.record, self.repeat, self.finished, self.frame_steps,
+         self.held, self.pressed, positions) = state
+        self.positions = positions.copy()
+
+    def matches(self):
+        # True if the replay followed exactly the recorded player path.
+        return self.positions.digest() == self.recorded_digest
+
@@ -0,0 +1,23 @@
+import pygame as pg
+from settings import *
+
+
+class RotationCache:
+    # An image rotated to a fixed number of angles ahead of time, so a
+    # rotated image is a lookup instead of a rotation (and a new surface)
+    # every frame. Angles are rounded to the nearest frame.
+    def __init__(self, image, frames=PLAYER_ROTATION_FRAMES):
+        self.frames = frames
+        self.frame_angle = 360 / frames
+        # The first frame is the image itself.
+        self.images = [image] + [pg.transform.rotate(image, frame *
+                                                     self.frame_angle)
+                                 for frame in range(1, frames)]
+        self.sizes = [image.get_size() for image in self.images]
+
+    def index(self, angle):
+        # Frame for an angle in degrees (counterclockwise).
+        return round(angle / self.frame_angle) % self.frames
+
+    def image(self, angle):
+        return self.images[self.index(angle)]
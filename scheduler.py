@@ -0,0 +1,98 @@
+from settings import *
+from spatial import SpatialGrid
+
+
+class UpdateScheduler:
+    # Keeps the lists of sprites that are updated every simulation step, in
+    # phases that are updated one after the other. Sprites without an area
+    # are always active. Sprites with an area (the part of the map they can
+    # be in) are only active while it is near the camera or a player: they
+    # wake when it comes within wake_distance, and sleep again when it is
+    # more than sleep_distance away. The sleep distance is bigger, so sprites
+    # near the edge do not keep switching. Sprites that wake up have their
+    # wake method called (if they have one) to catch up on the steps they
+    # slept through.
+    def __init__(self, phases, wake_distance=WAKE_DISTANCE,
+                 sleep_distance=SLEEP_DISTANCE, cell_size=DRAW_CELL_SIZE):
+        self.wake_distance = wake_distance
+        self.sleep_distance = sleep_distance
+        # Phase to the active sprites in it. Dicts are used as ordered sets,
+        # so sprites are always updated in the same order.
+        self.phases = {phase: {} for phase in phases}
+        # Sprite to its phase.
+        self.sprite_phases = {}
+        # Sprites with an area, in a grid so only the ones near the camera
+        # have to be checked for waking up.
+        self.region_grid = SpatialGrid(cell_size, "update_area")
+        self.awake = {}
+
+    def __len__(self):
+        return len(self.sprite_phases)
+
+    @property
+    def active_count(self):
+        return sum(len(sprites) for sprites in self.phases.values())
+
+    @property
+    def sleeping_count(self):
+        return len(self.region_grid) - len(self.awake)
+
+    def add(self, sprite, phase, area=None):
+        # Add a sprite that is always active, or that is active near its area
+        # (it starts asleep).
+        self.sprite_phases[sprite] = phase
+        if area is None:
+            self.phases[phase][sprite] = None
+        else:
+            sprite.update_area = area
+            self.region_grid.add(sprite)
+
+    def remove(self, sprite):
+        phase = self.sprite_phases.pop(sprite, None)
+        if phase is not None:
+            self.phases[phase].pop(sprite, None)
+            self.awake.pop(sprite, None)
+            self.region_grid.remove(sprite)
+
+    def snapshot(self):
+        # Which sprites are active.
+        return dict(self.awake), {phase: dict(sprites) for phase, sprites in
+                                  self.phases.items()}
+
+    def restore(self, state):
+        awake, phases = state
+        self.awake = dict(awake)
+        self.phases = {phase: dict(sprites) for phase, sprites in
+                       phases.items()}
+
+    def update_region(self, focus_rects):
+        # Wake and sleep the sprites with an area, by their distance to the
+        # focus rects (the camera view and the players).
+        sleep_rects = [rect.inflate(self.sleep_distance * 2,
+                                    self.sleep_distance * 2)
+                       for rect in focus_rects]
+        for sprite in list(self.awake):
+            if sprite.update_area.collidelist(sleep_rects) == -1:
+                del self.awake[sprite]
+                del self.phases[self.sprite_phases[sprite]][sprite]
+        for rect in focus_rects:
+            wake_rect = rect.inflate(self.wake_distance * 2,
+                                     self.wake_distance * 2)
+            for sprite in self.region_grid.query(wake_rect):
+                if sprite not in self.awake and \
+                        sprite.update_area.colliderect(wake_rect):
+                    self.awake[sprite] = None
+                    self.phases[self.sprite_phases[sprite]][sprite] = None
+                    wake = getattr(sprite, "wake", None)
+                    if wake:
+                        wake()
+
+    def update(self, phase, profiler=None):
+        # Update the active sprites in a phase, timed for each sprite class
+        # if the profiler is on.
+        sprites = list(self.phases[phase])
+        if profiler is not None and profiler.enabled:
+            profiler.update_sprites(sprites)
+        else:
+            for sprite in sprites:
+                sprite.update()
@@ -15,6 +15,12 @@ SKY = (135, 206, 250)
 SCREEN_WIDTH = 1440
 SCREEN_HEIGHT = 900
 FPS = 60
+# Simulation steps per second. The simulation runs at a fixed step rate no
+# matter how fast frames are drawn, and the drawing interpolates between the
+# last two simulation steps. If a frame takes too long, at most
+# MAX_SIM_STEPS steps are run to catch up and the rest of the time is dropped.
+SIM_RATE = 60
+MAX_SIM_STEPS = 5
 TITLE = "Game"
 BGCOLOR = SKY
 
@@ -25,12 +31,75 @@ GRID_HEIGHT = SCREEN_HEIGHT / TILESIZE
 OVERLAY_SIZE = 40
 TEXT_COLOR = WHITE
 THEME_FONT = "Booter.ttf"
+# Sprites are only drawn if they are on the screen. Sprites that move less
+# than DRAW_MARGIN pixels (like bobbing items) are not moved in the drawing
+# grid, so the screen is checked with this margin around it.
+DRAW_CELL_SIZE = TILESIZE * 4
+DRAW_MARGIN = TILESIZE
+# Only redraw the parts of the screen that changed while the camera is not
+# moving (toggle with R).
+DIRTY_RECTS = False
+# Number of rendered text surfaces to keep for reuse.
+TEXT_CACHE_SIZE = 128
+# Map rendering. The map is drawn from square chunks of CHUNK_SIZE tiles that
+# are rendered when they first come into view, and kept in a least recently
+# used cache that is limited to CHUNK_CACHE_BUDGET bytes.
+CHUNK_SIZE = 8
+CHUNK_CACHE_BUDGET = 32 * 1024 * 1024
+
+# Map loading. Maps are compiled into a binary cache next to the TMX file,
+# which is used instead of parsing the TMX file while it is up to date.
+MAP_CACHE = True
+MAP_CACHE_EXTENSION = ".mapc"
+# Reload the level when its map file is saved, checking the map folder every
+# HOT_RELOAD_INTERVAL seconds (not in headless games).
+HOT_RELOAD = True
+HOT_RELOAD_INTERVAL = 0.5
+
+# Collision settings.
+# Size of the cells in the spatial grids used for collision.
+COLLISION_CELL_SIZE = TILESIZE * 4
+# Array backend queries with at most this many candidates test them one at a
+# time in Python, which is faster than NumPy calls on a few values.
+FEW_CANDIDATES = 32
+# Merge touching and overlapping static walls into bigger rects when a map is
+# loaded.
+MERGE_WALLS = True
+# Collide with solid tiles as well as with wall objects. Tiles are solid if
+# they are in the COLLISION_LAYER tile layer, or if the tile has the
+# SOLID_TILE_PROPERTY property set in the tileset.
+TILE_COLLISION = False
+COLLISION_LAYER = None
+SOLID_TILE_PROPERTY = "solid"
+
+# How items and static walls are stored. "sprites" makes a sprite for each
+# one, "arrays" keeps them in NumPy arrays that are updated and collided with
+# all at once, which uses much less memory on levels with many of them.
+ENTITY_BACKEND = "sprites"
+
+# Update settings. Moving platforms far from the camera and the players do
+# not move. They wake up when the area their path covers comes within
+# WAKE_DISTANCE pixels, and sleep again when it is more than SLEEP_DISTANCE
+# pixels away.
+WAKE_DISTANCE = TILESIZE * 8
+SLEEP_DISTANCE = TILESIZE * 12
+
+# Profiler settings (toggle the profiler overlay with P, export with O).
+PROFILER_WINDOW = 300
+PROFILER_HISTORY = 36000
+PROFILER_EXPORT_FILE = "profile.csv"
 
 # Player settings.
 PLAYER_LAYER = 1
 # Player size.
 PLAYER_HIT_RECT_WIDTH = 35
 PLAYER_HIT_RECT_HEIGHT = 35
+# Number of angles the player image is rotated to when it is loaded, for the
+# spin movement mode.
+PLAYER_ROTATION_FRAMES = 72
+# Movement mode to start with, "jump" or "spin" (toggle with M). In spin mode
+# A and D (or left and right) turn, and space moves forwards.
+PLAYER_MOVEMENT_TYPE = "jump"
 # Player movement settings.
 PLAYER_MOVEMENT = {
     "jump": {
@@ -52,13 +121,26 @@ PLAYER_MOVEMENT = {
 GAME_IMG = "playerimg.png"
 GAME_BG_MUSIC = "grasslands.mp3"
 PLAYER_IMGS = ["playerimg.png"]
-WALL_IMGS = ["bridge.png", "sky.png"]
+WALL_IMGS = ["bridge.png"]
 ITEM_IMGS = ["coinGold.png"]
 
 # Sounds.
 SOUNDS = {
     "coin": "coin.wav"
 }
+# Sounds that are rarely played, which are decoded on the main thread the
+# first time they play instead of on the loading pool while the start screen
+# shows. Sounds that play often (like "coin") should not be listed, so they
+# never hold up a frame.
+LAZY_SOUNDS = []
+# Asset pack in the game folder that assets are loaded from instead of the
+# loose files while it exists, and the folders that are packed into it (make
+# it with python pack.py).
+ASSET_PACK = "assets.pack"
+PACK_FOLDERS = ["img", "snd", "fnt", "map"]
+# Number of threads that decode the images and sounds while the start screen
+# shows.
+ASSET_WORKERS = 4
 
 # Item settings.
 BOB_RANGE = 15
@@ -0,0 +1,144 @@
+import pygame as pg
+from settings import *
+
+
+class SpatialGrid:
+    # A uniform grid broadphase for collision and drawing queries. Sprites are
+    # stored in every cell that their rect touches, so a query only has to
+    # test the sprites in the cells around the query rect instead of a whole
+    # group.
+    def __init__(self, cell_size=COLLISION_CELL_SIZE, rect_name="hit_rect"):
+        self.cell_size = cell_size
+        # The sprite rect that is stored, hit_rect for collision or rect for
+        # drawing.
+        self.rect_name = rect_name
+        # Cell coordinates to the sprites in that cell. Dicts are used instead
+        # of sets so that queries always return sprites in the same order.
+        self.cells = {}
+        # Sprite to the range of cells it is in (left, top, right, bottom).
+        self.sprite_cells = {}
+        # Number of queries, for profiling.
+        self.queries = 0
+
+    def __len__(self):
+        return len(self.sprite_cells)
+
+    def cell_range(self, rect):
+        cell_size = self.cell_size
+        return (int(rect.left // cell_size), int(rect.top // cell_size),
+                int((rect.right - 1) // cell_size),
+                int((rect.bottom - 1) // cell_size))
+
+    def add(self, sprite):
+        cell_range = self.cell_range(getattr(sprite, self.rect_name))
+        self.sprite_cells[sprite] = cell_range
+        left, top, right, bottom = cell_range
+        for y in range(top, bottom + 1):
+            for x in range(left, right + 1):
+                cell = self.cells.get((x, y))
+                if cell is None:
+                    cell = self.cells[(x, y)] = {}
+                cell[sprite] = None
+
+    def remove(self, sprite):
+        cell_range = self.sprite_cells.pop(sprite, None)
+        if cell_range is None:
+            return
+        left, top, right, bottom = cell_range
+        for y in range(top, bottom + 1):
+            for x in range(left, right + 1):
+                cell = self.cells[(x, y)]
+                del cell[sprite]
+                if not cell:
+                    del self.cells[(x, y)]
+
+    def move(self, sprite):
+        # Update the cells of a sprite after its hit rect moved. Nothing has
+        # to change unless the sprite crossed into a different cell.
+        if self.sprite_cells.get(sprite) != \
+                self.cell_range(getattr(sprite, self.rect_name)):
+            self.remove(sprite)
+            self.add(sprite)
+
+    def query(self, rect):
+        # All sprites in the cells that the rect touches. These are only
+        # candidates, they may not actually overlap the rect.
+        self.queries += 1
+        left, top, right, bottom = self.cell_range(rect)
+        cells = self.cells
+        if left == right and top == bottom:
+            return list(cells.get((left, top), ()))
+        found = {}
+        for y in range(top, bottom + 1):
+            for x in range(left, right + 1):
+                cell = cells.get((x, y))
+                if cell:
+                    found.update(cell)
+        return list(found)
+
+    def collide(self, rect):
+        # All sprites with a hit rect (or rect) that overlaps the rect.
+        rect_name = self.rect_name
+        return [sprite for sprite in self.query(rect)
+                if getattr(sprite, rect_name).colliderect(rect)]
+
+
+def merge_rects(rects):
+    # Merge rects into fewer rects that cover exactly the same area. Rects in
+    # the same row (same top and bottom) that touch or overlap are joined,
+    # then rects in the same column, until nothing changes. Rects inside of
+    # another rect are removed. The result never has more rects than the
+    # input.
+    rects = [pg.Rect(rect) for rect in rects if rect.width > 0 and
+             rect.height > 0]
+    while True:
+        count = len(rects)
+        rects = remove_contained(rects)
+        rects = merge_runs(rects, "top", "bottom", "left", "right")
+        rects = merge_runs(rects, "left", "right", "top", "bottom")
+        if len(rects) == count:
+            return rects
+
+
+def merge_runs(rects, same_start, same_end, start, end):
+    # Join the rects that have the same start and end on one axis, and touch
+    # or overlap on the other axis.
+    lines = {}
+    for rect in rects:
+        key = (getattr(rect, same_start), getattr(rect, same_end))
+        lines.setdefault(key, []).append(rect)
+    merged = []
+    for line in lines.values():
+        line.sort(key=lambda rect: getattr(rect, start))
+        current = line[0]
+        for rect in line[1:]:
+            if getattr(rect, start) <= getattr(current, end):
+                if getattr(rect, end) > getattr(current, end):
+                    current = current.union(rect)
+            else:
+                merged.append(current)
+                current = rect
+        merged.append(current)
+    return merged
+
+
+def remove_contained(rects, cell_size=COLLISION_CELL_SIZE):
+    # Remove rects that are completely inside of another rect. Bigger rects
+    # are checked first, and each rect is only compared to the kept rects
+    # in the grid cells it touches.
+    rects = sorted(rects, key=lambda rect: rect.width * rect.height,
+                   reverse=True)
+    cells = {}
+    kept = []
+    for rect in rects:
+        left, top = rect.left // cell_size, rect.top // cell_size
+        right = (rect.right - 1) // cell_size
+        bottom = (rect.bottom - 1) // cell_size
+        candidates = cells.get((left, top), ())
+        if any(other.contains(rect) for other in candidates):
+            continue
+        kept.append(rect)
+        for y in range(top, bottom + 1):
+            for x in range(left, right + 1):
+                cells.setdefault((x, y), []).append(rect)
+    return kept
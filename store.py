@@ -0,0 +1,384 @@
+import math
+import numpy as np
+import pygame as pg
+from settings import *
+from bob import bob_table
+
+
+def round_half_away(values):
+    # Round like pygame does when a float is set on a rect.
+    return np.trunc(values + np.copysign(0.5, values))
+
+
+class ArrayGrid:
+    # A uniform grid over rects that are kept in arrays and do not move
+    # (much). Every pair of rect and cell it touches is stored, sorted by
+    # cell, so the rects in a cell are one slice of the owners.
+    def __init__(self, left, top, right, bottom, cell_size):
+        self.cell_size = cell_size
+        self.queries = 0
+        left_cells = np.floor_divide(left, cell_size)
+        top_cells = np.floor_divide(top, cell_size)
+        right_cells = np.floor_divide(right - 1, cell_size)
+        bottom_cells = np.floor_divide(bottom - 1, cell_size)
+        if len(left):
+            self.min_x = int(left_cells.min())
+            self.min_y = int(top_cells.min())
+            self.max_x = int(right_cells.max())
+            self.max_y = int(bottom_cells.max())
+        else:
+            self.min_x = self.min_y = 0
+            self.max_x = self.max_y = -1
+        self.columns = self.max_x - self.min_x + 1
+
+        # One entry for every cell of every rect.
+        widths = right_cells - left_cells + 1
+        counts = widths * (bottom_cells - top_cells + 1)
+        owners = np.repeat(np.arange(len(left), dtype=np.int32), counts)
+        starts = np.cumsum(counts) - counts
+        cell = np.arange(len(owners)) - np.repeat(starts, counts)
+        owner_widths = widths[owners]
+        cell_x = left_cells[owners] + cell % owner_widths - self.min_x
+        cell_y = top_cells[owners] + cell // owner_widths - self.min_y
+        keys = cell_y.astype(np.int64) * self.columns + cell_x
+        order = np.argsort(keys, kind="stable")
+        self.keys = keys[order]
+        self.owners = owners[order]
+        # Where the rects of each cell that has any are in owners, as
+        # (start, end), so a query is a few dict lookups.
+        cell_keys, cell_starts, cell_counts = np.unique(
+            self.keys, return_index=True, return_counts=True)
+        self.cells = dict(zip(cell_keys.tolist(), zip(
+            cell_starts.tolist(), (cell_starts + cell_counts).tolist())))
+        # Table of the rects in each cell for query_many, made on first use.
+        self.cell_keys = None
+        self.cell_table = None
+
+    def query(self, rect):
+        # Indices of the rects in the cells that the rect touches, as a
+        # sorted list. These are only candidates, they may not actually
+        # overlap the rect.
+        self.queries += 1
+        cell_size = self.cell_size
+        left = max(rect.left // cell_size, self.min_x) - self.min_x
+        top = max(rect.top // cell_size, self.min_y) - self.min_y
+        right = min((rect.right - 1) // cell_size, self.max_x) - self.min_x
+        bottom = min((rect.bottom - 1) // cell_size, self.max_y) - self.min_y
+        cells = self.cells
+        spans = []
+        for row in range(top, bottom + 1):
+            row_key = row * self.columns
+            for column in range(left, right + 1):
+                span = cells.get(row_key + column)
+                if span is not None:
+                    spans.append(span)
+        if len(spans) == 1:
+            start, end = spans[0]
+            return self.owners[start:end].tolist()
+        # Rects can be in more than one of the cells.
+        found = set()
+        for start, end in spans:
+            found.update(self.owners[start:end].tolist())
+        return sorted(found)
+
+    def make_cell_table(self):
+        # The rects in each cell that has any, as the rows of a table padded
+        # with -1, and one more row of -1 for the empty cells.
+        keys, starts, counts = np.unique(self.keys, return_index=True,
+                                         return_counts=True)
+        table = np.full((len(keys) + 1, max(counts.max(initial=0), 1)), -1,
+                        np.int32)
+        rows = np.repeat(np.arange(len(keys)), counts)
+        table[rows, np.arange(len(self.keys)) - starts[rows]] = self.owners
+        self.cell_keys = keys
+        self.cell_table = table
+        # Where the rects of each row start in owners, and how many there
+        # are.
+        self.cell_starts = np.append(starts, 0)
+        self.cell_counts = np.append(counts, 0)
+
+    def cell_rows(self, left, top, right, bottom):
+        # The rows of the cell table for the cells that each of many rects
+        # (arrays of their sides) touches, the empty row for cells without
+        # rects.
+        if self.cell_table is None:
+            self.make_cell_table()
+        cell_size = self.cell_size
+        first_x = np.floor_divide(left, cell_size)
+        first_y = np.floor_divide(top, cell_size)
+        last_x = np.floor_divide(right - 1, cell_size)
+        last_y = np.floor_divide(bottom - 1, cell_size)
+        # Number of cells across the widest rect.
+        span = int(max((last_x - first_x).max(initial=0),
+                       (last_y - first_y).max(initial=0))) + 1
+        empty = len(self.cell_keys)
+        if not empty:
+            return np.zeros((len(left), 1), np.int64)
+        cells = []
+        for y_offset in range(span):
+            y = first_y + y_offset
+            for x_offset in range(span):
+                x = first_x + x_offset
+                key = (y - self.min_y) * self.columns + x - self.min_x
+                row = np.minimum(np.searchsorted(self.cell_keys, key),
+                                 empty - 1)
+                found = (x <= last_x) & (y <= last_y) & \
+                    (x >= self.min_x) & (x <= self.max_x) & \
+                    (y >= self.min_y) & (y <= self.max_y) & \
+                    (self.cell_keys[row] == key)
+                cells.append(np.where(found, row, empty))
+        return np.stack(cells, axis=1)
+
+    def query_many(self, left, top, right, bottom):
+        # Candidates for many rects at once. Each row has the indices of the
+        # rects in the cells that one rect touches, padded with -1. A rect
+        # can be in a row more than once.
+        self.queries += 1
+        rows = self.cell_rows(left, top, right, bottom)
+        return self.cell_table[rows].reshape(len(left), -1)
+
+    def pairs_many(self, left, top, right, bottom):
+        # Candidates for many rects at once, as two arrays: the index of a
+        # rect, and of a candidate in a cell it touches. Unlike query_many
+        # there is no padding, which is less work when a few cells have
+        # many rects. A pair can be found more than once.
+        self.queries += 1
+        rows = self.cell_rows(left, top, right, bottom)
+        counts = self.cell_counts[rows].ravel()
+        total = int(counts.sum())
+        queries = np.repeat(np.arange(rows.size) // rows.shape[1], counts)
+        offsets = np.arange(total) - np.repeat(np.cumsum(counts) - counts,
+                                               counts)
+        starts = np.repeat(self.cell_starts[rows].ravel(), counts)
+        return queries, self.owners[starts + offsets]
+
+
+class WallView:
+    # A wall in a WallStore that was hit, with a hit rect like the wall
+    # sprites.
+    __slots__ = ("rect", "hit_rect")
+    color = GREEN
+
+    def __init__(self, rect):
+        self.rect = rect
+        self.hit_rect = rect
+
+
+class WallStore:
+    # Static walls as arrays of rects instead of sprites. Collision looks up
+    # the walls in an ArrayGrid and tests them all at once.
+    def __init__(self, rects, cell_size=COLLISION_CELL_SIZE):
+        self.left = np.array([rect.left for rect in rects], np.int32)
+        self.top = np.array([rect.top for rect in rects], np.int32)
+        self.right = np.array([rect.right for rect in rects], np.int32)
+        self.bottom = np.array([rect.bottom for rect in rects], np.int32)
+        self.grid = ArrayGrid(self.left, self.top, self.right, self.bottom,
+                              cell_size)
+        # Hit objects for the walls that have been hit, so they are only
+        # created once.
+        self.walls = {}
+
+    def __len__(self):
+        return len(self.left)
+
+    def collide(self, rect):
+        # The walls that overlap a rect.
+        found = self.grid.query(rect)
+        if len(found) <= FEW_CANDIDATES:
+            left, top, right, bottom = self.left, self.top, self.right, \
+                self.bottom
+            return [self.wall(index) for index in found
+                    if left[index] < rect.right and
+                    right[index] > rect.left and
+                    top[index] < rect.bottom and
+                    bottom[index] > rect.top]
+        found = np.array(found)
+        hits = found[(self.left[found] < rect.right) &
+                     (self.right[found] > rect.left) &
+                     (self.top[found] < rect.bottom) &
+                     (self.bottom[found] > rect.top)]
+        return [self.wall(int(index)) for index in hits]
+
+    def wall(self, index):
+        wall = self.walls.get(index)
+        if wall is None:
+            left, top = int(self.left[index]), int(self.top[index])
+            wall = self.walls[index] = WallView(pg.Rect(
+                left, top, int(self.right[index]) - left,
+                int(self.bottom[index]) - top))
+        return wall
+
+
+class ItemView:
+    # An item in an ItemStore, with the attributes that drawing and
+    # collision use from the item sprites. The rects are from when the view
+    # was last asked for.
+    __slots__ = ("store", "index", "item_type", "image", "rect", "hit_rect",
+                 "previous_center")
+    _layer = 0
+    color = YELLOW
+
+    def __init__(self, store, index):
+        self.store = store
+        self.index = index
+        code = store.type_codes[index]
+        self.item_type = store.item_types[code]
+        self.image = store.images[code]
+        self.rect = pg.Rect(0, 0, *self.image.get_size())
+        self.hit_rect = self.rect
+        self.previous_center = None
+
+    def destroy(self):
+        # Remove the item.
+        self.store.destroy(self.index)
+
+
+class ItemStore:
+    # Items (coins) as arrays instead of sprites, with the same bob
+    # animation as Item. Items that start the bob animation at the same step
+    # share a BobTable, so an update only looks up one offset for each table,
+    # and the items only become objects (ItemViews) while they are on the
+    # screen or hit. This takes a small part of the memory of a sprite for
+    # each item, and an update does not depend on the number of items.
+    def __init__(self, images, centers, item_types, steps,
+                 cell_size=COLLISION_CELL_SIZE):
+        # Item type names and images, indexed by the type codes.
+        self.item_types = sorted(set(item_types))
+        self.images = [images[item_type] for item_type in self.item_types]
+        codes = {item_type: code for code, item_type in
+                 enumerate(self.item_types)}
+        self.type_codes = np.array([codes[item_type] for item_type in
+                                    item_types], np.uint8)
+        sizes = np.array([image.get_size() for image in self.images],
+                         np.int32).reshape(-1, 2)
+        self.width = sizes[self.type_codes, 0]
+        self.height = sizes[self.type_codes, 1]
+        self.half_width = self.width // 2
+        self.half_height = self.height // 2
+
+        # Positions, the rect x positions never change.
+        centers = np.array(centers, np.float64).reshape(-1, 2)
+        self.center_y = centers[:, 1]
+        self.left = (round_half_away(centers[:, 0]) -
+                     self.half_width).astype(np.int32)
+        top = (round_half_away(self.center_y) -
+               self.half_height).astype(np.int32)
+        self.alive = np.ones(len(centers), bool)
+        self.alive_count = len(centers)
+
+        # Bob animation, the tables by the step they start at, the table of
+        # each item, and the offset of each table now and for the last step.
+        self.bob_tables = [bob_table(step) for step in sorted(set(steps))]
+        table_codes = {table: code for code, table in
+                       enumerate(self.bob_tables)}
+        self.bob_codes = np.array([table_codes[bob_table(step)] for step in
+                                   steps], np.uint8)
+        self.clock = 0
+        self.offsets = np.zeros(len(self.bob_tables))
+        self.previous_offsets = self.offsets
+
+        # The items can bob up to BOB_RANGE / 2 from where they start.
+        bob = BOB_RANGE // 2 + 1
+        self.grid = ArrayGrid(self.left, top - bob, self.left + self.width,
+                              top + self.height + bob, cell_size)
+        # Views of the items that were on the screen last frame.
+        self.views = {}
+
+    def __len__(self):
+        return self.alive_count
+
+    def offsets_at(self, clock):
+        # The offset of each table after a number of steps.
+        if not clock:
+            return np.zeros(len(self.bob_tables))
+        return np.array([table.offset(clock - 1) for table in
+                         self.bob_tables])
+
+    def update(self):
+        # Move the bob animation of every item on by one step.
+        self.clock += 1
+        self.previous_offsets = self.offsets
+        self.offsets = self.offsets_at(self.clock)
+
+    def set_clock(self, clock):
+        # Move the bob animation to a number of steps since the level
+        # started, for a store made after the level started.
+        self.clock = clock
+        self.offsets = self.offsets_at(clock)
+        self.previous_offsets = self.offsets_at(clock - 1) if clock else \
+            self.offsets
+
+    def overlapping(self, rect):
+        # Indices of the items that are alive and overlap a rect.
+        found = self.grid.query(rect)
+        if len(found) <= FEW_CANDIDATES:
+            hits = []
+            for index in found:
+                if not self.alive[index]:
+                    continue
+                left = self.left[index]
+                center_y = self.center_y[index] + \
+                    self.offsets[self.bob_codes[index]]
+                top = math.trunc(center_y + math.copysign(0.5, center_y)) - \
+                    self.half_height[index]
+                if left < rect.right and \
+                        left + self.width[index] > rect.left and \
+                        top < rect.bottom and \
+                        top + self.height[index] > rect.top:
+                    hits.append(index)
+            return hits
+        found = np.array(found)
+        left = self.left[found]
+        top = round_half_away(self.center_y[found] +
+                              self.offsets[self.bob_codes[found]]) - \
+            self.half_height[found]
+        return found[self.alive[found] & (left < rect.right) &
+                     (left + self.width[found] > rect.left) &
+                     (top < rect.bottom) &
+                     (top + self.height[found] > rect.top)]
+
+    def view(self, index):
+        # A view of an item, with its current rects.
+        view = self.views.get(index)
+        if view is None:
+            view = ItemView(self, index)
+        rect = view.rect
+        center_y = float(self.center_y[index])
+        code = self.bob_codes[index]
+        rect.x = int(self.left[index])
+        # Save the position from the last step for interpolated drawing.
+        if self.clock:
+            rect.centery = center_y + self.previous_offsets[code]
+            view.previous_center = rect.center
+        rect.centery = center_y + self.offsets[code]
+        return view
+
+    def collide(self, rect):
+        # The items that overlap a rect.
+        return [self.view(int(index)) for index in self.overlapping(rect)]
+
+    def on_screen(self, rect):
+        # Views of the items in a rect, the same objects as last time for
+        # the items that were already on the screen.
+        views = {}
+        for index in self.overlapping(rect):
+            index = int(index)
+            views[index] = self.view(index)
+        self.views = views
+        return list(views.values())
+
+    def snapshot(self):
+        return (self.alive.copy(), self.alive_count, self.clock, self.offsets,
+                self.previous_offsets)
+
+    def restore(self, state):
+        alive, self.alive_count, self.clock, self.offsets, \
+            self.previous_offsets = state
+        self.alive = alive.copy()
+        self.views = {}
+
+    def destroy(self, index):
+        if self.alive[index]:
+            self.alive[index] = False
+            self.alive_count -= 1
+        self.views.pop(index, None)
@@ -0,0 +1,61 @@
+from collections import OrderedDict
+import pygame as pg
+from settings import *
+
+
+class TextRenderer:
+    # Caches for drawing text. Fonts are loaded once for each (font, size),
+    # rendered strings are kept in a least recently used cache, and strings
+    # that change every frame (like counters) can be drawn one cached glyph
+    # at a time instead of being rendered again.
+    def __init__(self, cache_size=TEXT_CACHE_SIZE, open_font=None):
+        self.cache_size = cache_size
+        # Turns a font name into what pygame loads the font from (a file name
+        # or a file object), if font names are not file names.
+        self.open_font = open_font
+        self.fonts = {}
+        self.surfaces = OrderedDict()
+        self.glyphs = {}
+
+    def font(self, font_name, size):
+        key = (font_name, size)
+        font = self.fonts.get(key)
+        if font is None:
+            source = font_name
+            if self.open_font is not None and font_name is not None:
+                source = self.open_font(font_name)
+            font = self.fonts[key] = pg.font.Font(source, size)
+        return font
+
+    def render(self, text, color, font_name, size):
+        key = (text, tuple(color), font_name, size)
+        surface = self.surfaces.get(key)
+        if surface is not None:
+            self.surfaces.move_to_end(key)
+            return surface
+        surface = self.font(font_name, size).render(text, True, color)
+        self.surfaces[key] = surface
+        if len(self.surfaces) > self.cache_size:
+            self.surfaces.popitem(last=False)
+        return surface
+
+    def glyph(self, char, color, font_name, size):
+        key = (char, tuple(color), font_name, size)
+        glyph = self.glyphs.get(key)
+        if glyph is None:
+            glyph = self.glyphs[key] = \
+                self.font(font_name, size).render(char, True, color)
+        return glyph
+
+    def glyphs_size(self, text, color, font_name, size):
+        width = 0
+        for char in text:
+            width += self.glyph(char, color, font_name, size).get_width()
+        return width, self.font(font_name, size).get_height()
+
+    def blit_glyphs(self, surface, text, color, font_name, size, position):
+        x, y = position
+        for char in text:
+            glyph = self.glyph(char, color, font_name, size)
+            surface.blit(glyph, (x, y))
+            x += glyph.get_width()
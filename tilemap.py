@@ -1,6 +1,8 @@
+from collections import OrderedDict
+import numpy as np
 import pygame as pg
-import pytmx
 from settings import *
+from mapcache import load_map_data
 
 
 class Camera:
@@ -12,6 +14,14 @@ class Camera:
         self.height = map_height
         self.x = None
         self.y = None
+        # Camera position for the last two simulation steps, so drawing can
+        # interpolate between them.
+        self.sim_x = None
+        self.sim_y = None
+        self.previous_x = None
+        self.previous_y = None
+        # The part of the map that is on the screen, in map coordinates.
+        self.view_rect = pg.Rect(0, 0, screen_width, screen_height)
 
     def apply_sprite(self, sprite):
         return sprite.rect.move(self.rect.topleft)
@@ -19,6 +29,18 @@ class Camera:
     def apply_rect(self, rect):
         return rect.move(self.rect.topleft)
 
+    def apply_interpolated(self, sprite, alpha):
+        # Screen position of a sprite between its previous and current
+        # simulation step positions.
+        rect = sprite.rect
+        previous = getattr(sprite, "previous_center", None)
+        if previous is None or alpha >= 1:
+            return rect.x + self.x, rect.y + self.y
+        center_x = round(previous[0] + (rect.centerx - previous[0]) * alpha)
+        center_y = round(previous[1] + (rect.centery - previous[1]) * alpha)
+        return (center_x - rect.width // 2 + self.x,
+                center_y - rect.height // 2 + self.y)
+
     def update(self, target):
         # Make the target on the center of the screen
         self.x = -target.rect.centerx + self.screen_width / 2
@@ -38,27 +60,198 @@ class Camera:
 
         self.x, self.y = int(self.x), int(self.y)
 
+        if self.sim_x is None:
+            self.previous_x, self.previous_y = self.x, self.y
+        else:
+            self.previous_x, self.previous_y = self.sim_x, self.sim_y
+        self.sim_x, self.sim_y = self.x, self.y
+        self.set_position(self.x, self.y)
+
+    def hold(self):
+        # The camera did not move this simulation step.
+        self.previous_x, self.previous_y = self.sim_x, self.sim_y
+
+    def interpolate(self, alpha):
+        # Move the camera between the last two simulation steps for drawing.
+        self.set_position(
+            round(self.previous_x + (self.sim_x - self.previous_x) * alpha),
+            round(self.previous_y + (self.sim_y - self.previous_y) * alpha))
+
+    def snapshot(self):
+        return (self.x, self.y, self.sim_x, self.sim_y, self.previous_x,
+                self.previous_y)
+
+    def restore(self, state):
+        x, y, self.sim_x, self.sim_y, self.previous_x, self.previous_y = state
+        self.set_position(x, y)
+
+    def set_position(self, x, y):
+        self.x, self.y = x, y
         self.rect = pg.Rect(self.x, self.y, self.width, self.height)
+        self.view_rect.topleft = (-self.x, -self.y)
 
 
 class TiledMap:
-    def __init__(self, filename):
-        tilemap_data = pytmx.load_pygame(filename, pixelalpha=True)
-        self.width = tilemap_data.width * tilemap_data.tilewidth
-        self.height = tilemap_data.height * tilemap_data.tileheight
-        self.image = pg.Surface((self.width, self.height), pg.SRCALPHA)
-        self.rect = self.image.get_rect()
-        self.tilemap_data = tilemap_data
-
-    def render(self, surface):
-        tile_image = self.tilemap_data.get_tile_image_by_gid
-        for layer in self.tilemap_data.visible_layers:
-            if isinstance(layer, pytmx.TiledTileLayer):
-                for x, y, gid in layer:
-                    tile = tile_image(gid)
+    def __init__(self, filename, use_cache=MAP_CACHE, map_data=None):
+        # Map data comes from the compiled binary cache when it is fresh,
+        # otherwise from parsing the TMX file. Map data that was already
+        # loaded or generated can also be given instead.
+        if map_data is None:
+            map_data = load_map_data(filename, use_cache)
+        self.filename = filename
+        self.tilewidth = map_data.tilewidth
+        self.tileheight = map_data.tileheight
+        self.columns = map_data.width
+        self.rows = map_data.height
+        self.width = map_data.width * map_data.tilewidth
+        self.height = map_data.height * map_data.tileheight
+        self.rect = pg.Rect(0, 0, self.width, self.height)
+        self.layers = map_data.layers
+        self.tile_images = map_data.images
+        self.tile_properties = map_data.tile_properties
+        self.objects = map_data.objects
+
+        # Chunks are square blocks of tiles that are rendered on demand.
+        self.chunk_width = CHUNK_SIZE * self.tilewidth
+        self.chunk_height = CHUNK_SIZE * self.tileheight
+        self.chunk_columns = -(-self.columns // CHUNK_SIZE)
+        self.chunk_rows = -(-self.rows // CHUNK_SIZE)
+        self.chunk_bytes = self.chunk_width * self.chunk_height * 4
+        # Least recently used chunk surfaces, keyed by chunk coordinates. A
+        # chunk without any tiles is stored as None so it is never rendered
+        # again and never blitted.
+        self.chunks = OrderedDict()
+        self.chunk_memory = 0
+
+    def render(self, surface, area=None):
+        # Draw the tiles inside of area (the whole map if no area is given)
+        # onto the surface. The area's top left will be at (0, 0).
+        if area is None:
+            area = self.rect
+        tile_images = self.tile_images
+        tilewidth, tileheight = self.tilewidth, self.tileheight
+        columns = self.columns
+        first_x = max(0, area.left // tilewidth)
+        first_y = max(0, area.top // tileheight)
+        last_x = min(columns, -(-area.right // tilewidth))
+        last_y = min(self.rows, -(-area.bottom // tileheight))
+        drawn = False
+        for layer in self.layers:
+            if not layer.visible:
+                continue
+            data = layer.data
+            for y in range(first_y, last_y):
+                row = y * columns
+                for x in range(first_x, last_x):
+                    gid = data[row + x]
+                    if not gid:
+                        continue
+                    tile = tile_images[gid]
                     if tile:
-                        surface.blit(tile, (x * self.tilemap_data.tilewidth,
-                                            y * self.tilemap_data.tileheight))
+                        surface.blit(tile, (x * tilewidth - area.x,
+                                            y * tileheight - area.y))
+                        drawn = True
+        return drawn
+
+    def render_chunk(self, chunk_x, chunk_y):
+        area = pg.Rect(chunk_x * self.chunk_width, chunk_y * self.chunk_height,
+                       self.chunk_width, self.chunk_height)
+        surface = pg.Surface(area.size, pg.SRCALPHA)
+        if not self.render(surface, area):
+            # Empty chunk.
+            return None
+        return surface
+
+    def get_chunk(self, chunk_x, chunk_y):
+        key = (chunk_x, chunk_y)
+        if key in self.chunks:
+            self.chunks.move_to_end(key)
+            return self.chunks[key]
+        chunk = self.render_chunk(chunk_x, chunk_y)
+        self.chunks[key] = chunk
+        if chunk is not None:
+            self.chunk_memory += self.chunk_bytes
+        return chunk
+
+    def evict_chunks(self, keep=0):
+        # Remove the least recently used chunks until the cache fits in the
+        # memory budget. The last "keep" chunks were used for the current
+        # frame, so they are never removed.
+        while self.chunk_memory > CHUNK_CACHE_BUDGET and \
+                len(self.chunks) > keep:
+            key, chunk = self.chunks.popitem(last=False)
+            if chunk is not None:
+                self.chunk_memory -= self.chunk_bytes
+
+    def invalidate_chunks(self):
+        self.chunks.clear()
+        self.chunk_memory = 0
+
+    def invalidate_chunk(self, key):
+        if key in self.chunks and self.chunks.pop(key) is not None:
+            self.chunk_memory -= self.chunk_bytes
+
+    def update_tiles(self, map_data, images_changed=False):
+        # Take the tiles from a new version of the map (of the same size),
+        # and only throw away the chunks with tiles that changed. All of
+        # them are thrown away if the tile images changed. Returns True if
+        # any tiles changed.
+        old_layers = {layer.name: layer for layer in self.layers}
+        self.layers = map_data.layers
+        self.tile_images = map_data.images
+        self.tile_properties = map_data.tile_properties
+        if images_changed:
+            self.invalidate_chunks()
+            return True
+        changed = []
+        for layer in self.layers:
+            data = np.frombuffer(layer.data, np.uint32)
+            old_layer = old_layers.pop(layer.name, None)
+            if old_layer is None or old_layer.visible != layer.visible:
+                # Every tile of a new layer (or one that was shown or hidden)
+                # changed.
+                changed.append(np.flatnonzero(data))
+            else:
+                changed.append(np.flatnonzero(
+                    data != np.frombuffer(old_layer.data, np.uint32)))
+        for old_layer in old_layers.values():
+            # Removed layers.
+            changed.append(np.flatnonzero(np.frombuffer(old_layer.data,
+                                                        np.uint32)))
+        tiles = np.concatenate(changed) if changed else np.zeros(0, int)
+        chunk_x = tiles % self.columns // CHUNK_SIZE
+        chunk_y = tiles // self.columns // CHUNK_SIZE
+        for key in set(zip(chunk_x.tolist(), chunk_y.tolist())):
+            self.invalidate_chunk(key)
+        return len(tiles) > 0
+
+    def visible_chunks(self, view):
+        # Chunk coordinates that intersect the view rect (in map coordinates).
+        first_x = max(0, view.left // self.chunk_width)
+        first_y = max(0, view.top // self.chunk_height)
+        last_x = min(self.chunk_columns, -(-view.right // self.chunk_width))
+        last_y = min(self.chunk_rows, -(-view.bottom // self.chunk_height))
+        for chunk_y in range(first_y, last_y):
+            for chunk_x in range(first_x, last_x):
+                yield chunk_x, chunk_y
+
+    def draw(self, surface, camera, area=None):
+        # Only blit the chunks that can be seen by the camera, or that are in
+        # the area of the screen if one is given.
+        if area is None:
+            view = camera.view_rect
+        else:
+            view = area.move(-camera.x, -camera.y)
+        used = 0
+        for chunk_x, chunk_y in self.visible_chunks(view):
+            chunk = self.get_chunk(chunk_x, chunk_y)
+            used += 1
+            if chunk is not None:
+                surface.blit(chunk, (chunk_x * self.chunk_width + camera.x,
+                                     chunk_y * self.chunk_height + camera.y))
+        self.evict_chunks(used)
 
     def make_map(self):
-        self.render(self.image)
+        # Chunks are rendered lazily when drawn, so just start with an empty
+        # cache.
+        self.invalidate_chunks()
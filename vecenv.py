@@ -0,0 +1,388 @@
+import os
+import numpy as np
+import pygame as pg
+from settings import *
+from spatial import merge_rects
+from occupancy import OccupancyGrid
+from store import ArrayGrid, round_half_away
+from bob import bob_table
+from tilemap import TiledMap
+from entities import item_image
+
+# Action bits, the keys held down by an agent. Pushing jump in the air (jump
+# held now but not last step) wall jumps, like pushing space in the game.
+ACTION_LEFT = 1
+ACTION_RIGHT = 2
+ACTION_JUMP = 4
+# Observation columns.
+OBSERVATIONS = ["x", "y", "vel_x", "vel_y", "on_ground", "jumping"]
+# Agents that fall this far below the map are done.
+FALL_DISTANCE = TILESIZE * 10
+
+
+def image_size(filename, cache={}):
+    # Size of an image in the img folder.
+    size = cache.get(filename)
+    if size is None:
+        size = cache[filename] = pg.image.load(os.path.join(
+            os.path.dirname(os.path.abspath(__file__)), "img",
+            filename)).get_size()
+    return size
+
+
+class MapGeometry:
+    # What the agents collide with in a map, in arrays: the static walls
+    # (merged like the game merges them), the solid tiles, and the items
+    # (the size of their images, like the item sprites). Moving platforms
+    # are left out.
+    def __init__(self, tiled_map, cell_size=COLLISION_CELL_SIZE):
+        self.width = tiled_map.width
+        self.height = tiled_map.height
+        walls = [pg.Rect(tile_object.x, tile_object.y, tile_object.width,
+                         tile_object.height)
+                 for tile_object in tiled_map.objects
+                 if tile_object.object == "obstacle" and
+                 tile_object.type == "wall"]
+        if MERGE_WALLS:
+            walls = merge_rects(walls)
+        if TILE_COLLISION:
+            # Solid tiles are not merged, the same as the game.
+            solid = OccupancyGrid.from_map(tiled_map).solid
+            for row, column in zip(*np.nonzero(solid)):
+                walls.append(pg.Rect(
+                    int(column) * tiled_map.tilewidth,
+                    int(row) * tiled_map.tileheight, tiled_map.tilewidth,
+                    tiled_map.tileheight))
+        self.wall_left = np.array([rect.left for rect in walls], np.int64)
+        self.wall_top = np.array([rect.top for rect in walls], np.int64)
+        self.wall_right = np.array([rect.right for rect in walls], np.int64)
+        self.wall_bottom = np.array([rect.bottom for rect in walls],
+                                    np.int64)
+        self.wall_grid = ArrayGrid(self.wall_left, self.wall_top,
+                                   self.wall_right, self.wall_bottom,
+                                   cell_size)
+
+        # Items, with the bob animation tables padded into one array. The
+        # item rects are the same as in ItemStore.
+        items = [tile_object for tile_object in tiled_map.objects
+                 if tile_object.object == "item"]
+        self.item_count = len(items)
+        centers = np.array([(tile_object.x + tile_object.width / 2,
+                             tile_object.y + tile_object.height / 2)
+                            for tile_object in items],
+                           np.float64).reshape(-1, 2)
+        sizes = np.array([image_size(item_image(tile_object.type))
+                          for tile_object in items], np.int64).reshape(-1, 2)
+        self.item_width = sizes[:, 0]
+        self.item_height = sizes[:, 1]
+        self.item_left = round_half_away(centers[:, 0]).astype(np.int64) - \
+            self.item_width // 2
+        self.item_center_y = centers[:, 1]
+        # Items start bobbing at step 0 (RANDOM_START_STEP is for the game).
+        table = bob_table(0)
+        self.bob_offsets = np.array(table.offsets)
+        self.bob_loop_start = table.loop_start
+        self.bob_loop_length = table.loop_length
+        # Boxes around where the items can bob to.
+        bob = BOB_RANGE // 2 + 1
+        top = round_half_away(self.item_center_y).astype(np.int64) - \
+            self.item_height // 2
+        self.item_box_left = self.item_left
+        self.item_box_top = top - bob
+        self.item_box_right = self.item_left + self.item_width
+        self.item_box_bottom = top + self.item_height + bob
+        self.item_grid = ArrayGrid(self.item_box_left, self.item_box_top,
+                                   self.item_box_right, self.item_box_bottom,
+                                   cell_size)
+
+    def walls_hit(self, left, top, right, bottom):
+        # Which of the rects overlap any wall.
+        found = self.wall_grid.query_many(left, top, right, bottom)
+        return overlaps(found, self.wall_left, self.wall_top,
+                        self.wall_right, self.wall_bottom,
+                        left, top, right, bottom).any(axis=1)
+
+    def bob_offset(self, clock):
+        # The item bob offset after a number of steps since the level
+        # started, the same as BobTable.offset(clock - 1).
+        steps = np.maximum(clock - 1, 0)
+        looped = self.bob_loop_start + (steps - self.bob_loop_start) % \
+            self.bob_loop_length
+        steps = np.where(steps >= len(self.bob_offsets), looped, steps)
+        return np.where(clock > 0, self.bob_offsets[steps], 0.0)
+
+
+def overlaps(found, wall_left, wall_top, wall_right, wall_bottom, left, top,
+             right, bottom):
+    # Which candidates (rows of indices from query_many, -1 for none)
+    # overlap the rect of their row, like Rect.colliderect.
+    valid = found >= 0
+    found = np.where(valid, found, 0)
+    return valid & (wall_left[found] < right[:, None]) & \
+        (wall_right[found] > left[:, None]) & \
+        (wall_top[found] < bottom[:, None]) & \
+        (wall_bottom[found] > top[:, None])
+
+
+class VecEnv:
+    # Many independent players (agents) in one level, stepped all at once
+    # with NumPy. The movement is the same as the jump movement of Player
+    # (gravity, friction, jumps, wall jumps and wall slides, swept collision
+    # one axis at a time), against the static walls and solid tiles of the
+    # map. Moving platforms are not simulated. Each agent collects its own
+    # coins.
+    #   env = VecEnv.from_map("map/map1.tmx", 1024)
+    #   observations = env.reset()
+    #   observations, rewards, dones = env.step(actions)
+    # Actions are ACTION_* bits for each agent, observations are the
+    # OBSERVATIONS columns for each agent, rewards are the number of coins
+    # collected in the step, and agents that are done (fell out of the map,
+    # collected every coin, or ran for max_steps) start again.
+    def __init__(self, tiled_map, agents, start=(100, 1800), max_steps=3600,
+                 dt=1 / SIM_RATE):
+        self.geometry = MapGeometry(tiled_map)
+        self.agents = agents
+        self.start = start
+        self.max_steps = max_steps
+        self.dt = dt
+        self.width = PLAYER_HIT_RECT_WIDTH
+        self.height = PLAYER_HIT_RECT_HEIGHT
+        movement = PLAYER_MOVEMENT["jump"]
+        self.friction = movement["friction"]
+        self.acc = movement["acc"]
+        self.jump = movement["jump"]
+        self.gravity = movement["gravity"]
+        self.wall_jump = movement["wall jump"]
+        self.wall_slide = movement["wall slide"]
+
+        self.pos_x = np.zeros(agents)
+        self.pos_y = np.zeros(agents)
+        self.vel_x = np.zeros(agents)
+        self.vel_y = np.zeros(agents)
+        # Hit rect top left.
+        self.left = np.zeros(agents, np.int64)
+        self.top = np.zeros(agents, np.int64)
+        self.on_ground = np.zeros(agents, bool)
+        self.jumping = np.zeros(agents, bool)
+        self.jump_held = np.zeros(agents, bool)
+        # Gravity orientation of each agent (1 is down, -1 is up).
+        self.gravity_orientation = np.ones(agents, np.int64)
+        # Steps since each agent started.
+        self.clock = np.zeros(agents, np.int64)
+        self.collected = np.zeros((agents, self.geometry.item_count), bool)
+        self.coins = np.zeros(agents, np.int64)
+
+    @classmethod
+    def from_map(cls, filename, agents, **kwargs):
+        return cls(TiledMap(filename), agents, **kwargs)
+
+    def reset(self, agents=None):
+        # Start the agents (all of them, or a boolean mask of them) again.
+        # Returns the observations.
+        if agents is None:
+            agents = np.ones(self.agents, bool)
+        x, y = self.start
+        self.pos_x[agents] = x
+        self.pos_y[agents] = y
+        self.vel_x[agents] = 0
+        self.vel_y[agents] = 0
+        # Same as Player, the hit rect centered on the start.
+        self.left[agents] = int(x) - self.width // 2
+        self.top[agents] = int(y) - self.height // 2
+        self.on_ground[agents] = False
+        self.jumping[agents] = False
+        self.jump_held[agents] = False
+        self.gravity_orientation[agents] = 1
+        self.clock[agents] = 0
+        self.collected[agents] = False
+        self.coins[agents] = 0
+        return self.observations()
+
+    def observations(self):
+        return np.stack([self.pos_x, self.pos_y, self.vel_x, self.vel_y,
+                         self.on_ground, self.jumping],
+                        axis=1).astype(np.float32)
+
+    def step(self, actions):
+        actions = np.asarray(actions)
+        left_key = actions & ACTION_LEFT != 0
+        right_key = actions & ACTION_RIGHT != 0
+        jump_key = actions & ACTION_JUMP != 0
+        self.clock += 1
+
+        # Wall jumps, before moving (Game.events runs before Game.update).
+        pushed = jump_key & ~self.jump_held & ~self.on_ground
+        self.jump_held = jump_key
+        if pushed.any():
+            self.wall_jumps(np.flatnonzero(pushed))
+
+        self.move(left_key, right_key, jump_key)
+        self.collide_walls()
+        rewards = self.collide_items()
+
+        # Agents that are done start again.
+        dones = (self.clock >= self.max_steps) | \
+            (self.pos_y > self.geometry.height + FALL_DISTANCE) | \
+            (self.coins == self.geometry.item_count)
+        if dones.any():
+            self.reset(dones)
+        return self.observations(), rewards.astype(np.float32), dones
+
+    def wall_jumps(self, agents):
+        # Jump off a wall next to the agent (1 pixel to the right, or else to
+        # the left), see Player.try_jump.
+        left, top = self.left[agents], self.top[agents]
+        right, bottom = left + self.width, top + self.height
+        geometry = self.geometry
+        wall_right = geometry.walls_hit(left + 1, top, right + 1, bottom)
+        wall_left = ~wall_right & geometry.walls_hit(left - 1, top,
+                                                     right - 1, bottom)
+        direction = np.where(wall_right, -1, np.where(wall_left, 1, 0))
+        jumped = direction != 0
+        agents = agents[jumped]
+        self.jumping[agents] = True
+        self.vel_y[agents] = self.jump * self.gravity_orientation[agents]
+        self.vel_x[agents] = self.wall_jump * direction[jumped]
+
+    def move(self, left_key, right_key, jump_key):
+        # Same as Player.move and Player.apply_keys.
+        acc_x = np.where(right_key, self.acc,
+                         np.where(left_key, -self.acc, 0.0))
+        acc_y = (self.gravity * self.gravity_orientation).astype(np.float64)
+        jumped = jump_key & ~self.jumping & self.on_ground
+        self.jumping |= jumped
+        self.vel_y = np.where(jumped, self.jump * self.gravity_orientation,
+                              self.vel_y)
+        # Friction.
+        acc_x += self.vel_x * self.friction
+        acc_y += self.vel_y * self.friction
+        dt = self.dt
+        self.vel_x = self.vel_x + acc_x * dt
+        self.vel_y = self.vel_y + acc_y * dt
+        self.pos_x = self.pos_x + (self.vel_x * dt + 0.5 * acc_x * dt ** 2)
+        self.pos_y = self.pos_y + (self.vel_y * dt + 0.5 * acc_y * dt ** 2)
+
+    def collide_walls(self):
+        # Same as Player.collide_walls without the moving platforms. The hit
+        # rect is swept along x, then along y, against the walls near the
+        # whole path.
+        geometry = self.geometry
+        width, height = self.width, self.height
+        start_left, start_top = self.left, self.top
+        end_left = round_half_away(self.pos_x).astype(np.int64) - width // 2
+        end_top = round_half_away(self.pos_y).astype(np.int64) - height // 2
+        path_left = np.minimum(start_left, end_left)
+        path_top = np.minimum(start_top, end_top)
+        path_right = np.maximum(start_left, end_left) + width
+        path_bottom = np.maximum(start_top, end_top) + height
+        found = geometry.wall_grid.query_many(path_left, path_top,
+                                              path_right, path_bottom)
+        nearby = overlaps(found, geometry.wall_left, geometry.wall_top,
+                          geometry.wall_right, geometry.wall_bottom,
+                          path_left, path_top, path_right, path_bottom)
+        found = np.where(nearby, found, 0)
+        wall_left = geometry.wall_left[found]
+        wall_top = geometry.wall_top[found]
+        wall_right = geometry.wall_right[found]
+        wall_bottom = geometry.wall_bottom[found]
+
+        # Along x, from the start to the new x position.
+        sweep_left = np.minimum(start_left, end_left)
+        sweep_right = np.maximum(start_left, end_left) + width
+        hits = nearby & (wall_left < sweep_right[:, None]) & \
+            (wall_right > sweep_left[:, None]) & \
+            (wall_top < (start_top + height)[:, None]) & \
+            (wall_bottom > start_top[:, None])
+        hit = hits.any(axis=1)
+        # The side to stop at is from the way the hit rect moved, or the
+        # velocity if it did not move, like Player.
+        moved = np.where(end_left != start_left, end_left - start_left,
+                         self.vel_x)
+        moving_right = hit & (moved > 0)
+        moving_left = hit & (moved < 0)
+        hit_left = np.where(hits, wall_left, np.iinfo(np.int64).max).min(
+            axis=1, initial=np.iinfo(np.int64).max)
+        hit_right = np.where(hits, wall_right, np.iinfo(np.int64).min).max(
+            axis=1, initial=np.iinfo(np.int64).min)
+        self.pos_x = np.where(moving_right, hit_left - width / 2, self.pos_x)
+        self.pos_x = np.where(moving_left, hit_right + width / 2, self.pos_x)
+        left = np.where(moving_right, hit_left - width,
+                        np.where(moving_left, hit_right, end_left))
+        self.vel_x = np.where(moving_right | moving_left, 0.0, self.vel_x)
+        # Wall slide when in the air and going the way gravity pulls.
+        falling = (self.vel_y >= 0) & (self.gravity_orientation == 1) | \
+            (self.vel_y <= 0) & (self.gravity_orientation == -1)
+        self.vel_y = np.where(hit & ~self.on_ground & falling,
+                              self.vel_y * self.wall_slide, self.vel_y)
+
+        # Along y, from the start to the new y position.
+        sweep_top = np.minimum(start_top, end_top)
+        sweep_bottom = np.maximum(start_top, end_top) + height
+        hits = nearby & (wall_left < (left + width)[:, None]) & \
+            (wall_right > left[:, None]) & \
+            (wall_top < sweep_bottom[:, None]) & \
+            (wall_bottom > sweep_top[:, None])
+        hit = hits.any(axis=1)
+        moved = np.where(end_top != start_top, end_top - start_top,
+                         self.vel_y)
+        moving_down = hit & (moved > 0)
+        moving_up = hit & (moved < 0)
+        hit_top = np.where(hits, wall_top, np.iinfo(np.int64).max).min(
+            axis=1, initial=np.iinfo(np.int64).max)
+        hit_bottom = np.where(hits, wall_bottom, np.iinfo(np.int64).min).max(
+            axis=1, initial=np.iinfo(np.int64).min)
+        # Player uses the hit rect width here too.
+        self.pos_y = np.where(moving_down, hit_top - width / 2, self.pos_y)
+        self.pos_y = np.where(moving_up, hit_bottom + width / 2, self.pos_y)
+        top = np.where(moving_down, hit_top - height,
+                       np.where(moving_up, hit_bottom, end_top))
+        landed = moving_down & (self.gravity_orientation == 1) | \
+            moving_up & (self.gravity_orientation == -1)
+        # Without a hit, the agent is in the air (there are no platforms to
+        # be near).
+        self.on_ground = np.where(hit, self.on_ground | landed, False)
+        self.jumping &= ~landed
+        self.vel_y = np.where(hit, 0.0, self.vel_y)
+        self.left = left
+        self.top = top
+
+    def collide_items(self):
+        # Collect the items the agents touch. Returns the number of items
+        # each agent collected.
+        geometry = self.geometry
+        rewards = np.zeros(self.agents, np.int64)
+        if not geometry.item_count:
+            return rewards
+        left, top = self.left, self.top
+        right, bottom = left + self.width, top + self.height
+        agents, found = geometry.item_grid.pairs_many(left, top, right,
+                                                      bottom)
+        # Most pairs are not near, so the boxes of the items are checked
+        # first.
+        near = (geometry.item_box_left[found] < right[agents]) & \
+            (geometry.item_box_right[found] > left[agents]) & \
+            (geometry.item_box_top[found] < bottom[agents]) & \
+            (geometry.item_box_bottom[found] > top[agents])
+        agents, found = agents[near], found[near]
+        near = ~self.collected[agents, found]
+        agents, found = agents[near], found[near]
+        if not len(agents):
+            return rewards
+        item_left = geometry.item_left[found]
+        item_top = round_half_away(
+            geometry.item_center_y[found] +
+            geometry.bob_offset(self.clock[agents])).astype(np.int64) - \
+            geometry.item_height[found] // 2
+        hits = (item_left < right[agents]) & \
+            (item_left + geometry.item_width[found] > left[agents]) & \
+            (item_top < bottom[agents]) & \
+            (item_top + geometry.item_height[found] > top[agents])
+        if not hits.any():
+            return rewards
+        # An item can be found in more than one cell, so only count it once.
+        pairs = np.unique(agents[hits] * geometry.item_count + found[hits])
+        hit_agents = pairs // geometry.item_count
+        self.collected[hit_agents, pairs % geometry.item_count] = True
+        rewards = np.bincount(hit_agents, minlength=self.agents)
+        self.coins += rewards
+        return rewards
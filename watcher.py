@@ -0,0 +1,45 @@
+import os
+import time
+from settings import *
+
+
+class FolderWatcher:
+    # Finds the files in a folder that were changed, added or removed, by
+    # polling their modification times at most once every interval seconds.
+    # Files with one of the ignored extensions (like the map caches the game
+    # writes itself) are left out.
+    def __init__(self, folder, interval=HOT_RELOAD_INTERVAL,
+                 ignore=(MAP_CACHE_EXTENSION, ".tmp")):
+        self.folder = folder
+        self.interval = interval
+        self.ignore = ignore
+        self.mtimes = self.scan()
+        self.next_poll = time.perf_counter() + interval
+
+    def scan(self):
+        mtimes = {}
+        try:
+            entries = list(os.scandir(self.folder))
+        except OSError:
+            return mtimes
+        for entry in entries:
+            if entry.name.endswith(self.ignore):
+                continue
+            try:
+                mtimes[entry.path] = entry.stat().st_mtime_ns
+            except OSError:
+                # Removed while scanning.
+                pass
+        return mtimes
+
+    def poll(self):
+        # The paths of the files that changed since the last poll.
+        now = time.perf_counter()
+        if now < self.next_poll:
+            return []
+        self.next_poll = now + self.interval
+        mtimes = self.scan()
+        changed = [path for path in mtimes.keys() | self.mtimes.keys()
+                   if mtimes.get(path) != self.mtimes.get(path)]
+        self.mtimes = mtimes
+        return changed